@@ -1,37 +1,168 @@
 import functions_framework
-import json
+import orjson
 import uuid
 import os
-import requests
-from google.cloud import firestore, storage, secretmanager
+from google.cloud import firestore, storage
 from datetime import datetime
 import base64
+import io
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 # Initialize Firestore DB
 db = firestore.Client()
 # Initialize Cloud Storage
 storage_client = storage.Client()
 bucket_name = "duoligo-pt-app-videos"  # This bucket should be created in GCP
+# Set VIDEO_BUCKET_UNIFORM_ACCESS=true once the bucket has been migrated to uniform
+# bucket-level access with an allUsers:objectViewer binding. Until then each uploaded
+# video is made public with an object ACL (make_public fails under uniform access)
+VIDEO_BUCKET_UNIFORM_ACCESS = os.environ.get('VIDEO_BUCKET_UNIFORM_ACCESS', 'false').lower() == 'true'
+# Upload videos in resumable 8MB chunks instead of one in-memory request body
+VIDEO_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
 
+# Secret Manager client and LLM HTTP session, created on first use so requests
+# that reuse an existing exercise never import or build them
+secret_client = None
+http_session = None
+
+# A single structured exercise is a small task, so use the fast model tiers
+CLAUDE_MODEL = os.environ.get('CLAUDE_MODEL', "claude-3-5-haiku-20241022")
+OPENAI_MODEL = os.environ.get('OPENAI_MODEL', "gpt-4o-mini")
+LLM_MAX_TOKENS = 600
+
+# (connect, read) timeout in seconds for LLM requests
+LLM_REQUEST_TIMEOUT = (10, 60)
+
+# System prompt shared by the Claude and OpenAI exercise generators
+SYSTEM_PROMPT = "You are a senior physical therapist specializing in knee rehabilitation."
+
+# Exercise prompt templates; only the exercise name and PT instructions vary per request
+CLAUDE_EXERCISE_PROMPT = """
+    I need detailed information about a knee rehabilitation exercise called "{exercise_name}".
+    
+    Additional instructions from the physical therapist:
+    {voice_instructions}
+    
+    Please provide:
+    1. A concise description of the exercise
+    2. Target joints it affects
+    3. Step-by-step instructions
+    4. A URL for a representative video if you know of one
+    
+    Format your response as JSON according to this structure:
+    ```json
+    {{
+      "name": "{exercise_name}",
+      "description": "Brief description of the exercise",
+      "target_joints": ["knee", "ankle"],
+      "instructions": [
+        "Step 1",
+        "Step 2",
+        "Step 3"
+      ],
+      "video_url": "https://example.com/video.mp4"
+    }}
+    ```
+    
+    Respond ONLY with the JSON object and nothing else.
+    """
+
+OPENAI_EXERCISE_PROMPT = """
+    I need detailed information about a knee rehabilitation exercise called "{exercise_name}".
+    
+    Additional instructions from the physical therapist:
+    {voice_instructions}
+    
+    Please provide:
+    1. A concise description of the exercise
+    2. Target joints it affects
+    3. Step-by-step instructions
+    4. A URL for a representative video if you know of one
+    
+    Format your response as JSON according to this structure:
+    {{
+      "name": "{exercise_name}",
+      "description": "Brief description of the exercise",
+      "target_joints": ["knee", "ankle"],
+      "instructions": [
+        "Step 1",
+        "Step 2",
+        "Step 3"
+      ],
+      "video_url": "https://example.com/video.mp4"
+    }}
+    
+    Respond ONLY with the JSON object and nothing else.
+    """
+
+# Opening fence of a JSON block in an LLM response
+JSON_FENCE = '```json'
+
+
+# orjson fallback for types it does not serialize natively
+def json_default(obj):
+    # Handle datetime subclasses such as Firestore's DatetimeWithNanoseconds
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    # Handle protobuf-style timestamps
+    if hasattr(obj, 'seconds') and hasattr(obj, 'nanos'):
+        return datetime.fromtimestamp(obj.seconds + obj.nanos/1e9).isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def get_secret_client():
+    """
+    Return the shared Secret Manager client, creating it on first use
+    """
+    global secret_client
+    if secret_client is None:
+        from google.cloud import secretmanager
+        secret_client = secretmanager.SecretManagerServiceClient()
+    return secret_client
+
+
+def get_http_session():
+    """
+    Return the shared HTTP session for LLM calls, creating it on first use.
+    Warm instances reuse its pooled TLS connections.
+    """
+    global http_session
+    if http_session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=8,
+            # LLM calls are billed POSTs, so they are only retried when the connection
+            # could not be made; read timeouts and error statuses are never replayed.
+            # Backoff is capped and Retry-After ignored to keep the total wait bounded
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                backoff_max=5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=frozenset(['GET']),
+                respect_retry_after_header=False,
+                raise_on_status=False
+            )
+        ))
+        http_session = session
+    return http_session
 
-# Custom JSON encoder to handle datetime objects
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        # Handle Firestore's DatetimeWithNanoseconds
-        if hasattr(obj, 'seconds') and hasattr(obj, 'nanos'):
-            return datetime.fromtimestamp(obj.seconds + obj.nanos/1e9).isoformat()
-        return super(DateTimeEncoder, self).default(obj)
 
 # Secret Manager setup
+@lru_cache(maxsize=16)
 def access_secret_version(secret_id, version_id="latest"):
     """
-    Access the secret from GCP Secret Manager
+    Access the secret from GCP Secret Manager.
+    Results are cached for the lifetime of the function instance.
     """
-    client = secretmanager.SecretManagerServiceClient()
     name = f"projects/{os.environ['PROJECT_ID']}/secrets/{secret_id}/versions/{version_id}"
-    response = client.access_secret_version(request={"name": name})
+    response = get_secret_client().access_secret_version(request={"name": name})
     return response.payload.data.decode("UTF-8")
 
 @functions_framework.http
@@ -69,7 +200,7 @@ def add_custom_exercise(request):
         request_json = request.get_json(silent=True)
         
         if not request_json or 'exercise_name' not in request_json:
-            return (json.dumps({'error': 'Invalid request - missing exercise_name'}, cls=DateTimeEncoder), 400, headers)
+            return (orjson.dumps({'error': 'Invalid request - missing exercise_name'}, default=json_default), 400, headers)
         
         pt_id = request_json.get('pt_id')
         patient_id = request_json.get('patient_id')
@@ -78,64 +209,69 @@ def add_custom_exercise(request):
         custom_video = request_json.get('custom_video')
         voice_instructions = request_json.get('voice_instructions', '')
         
-        # 1. First, check if a similar exercise already exists
-        similar_exercises = db.collection('exercises').where('name', '==', exercise_name).limit(1).get()
-        
-        if len(similar_exercises) > 0:
-            # Use existing exercise as a starting point
-            existing_exercise = similar_exercises[0].to_dict()
-            exercise_data = existing_exercise.copy()
-            exercise_data['original_exercise_id'] = existing_exercise['id']
-        else:
-            # Use LLM to generate exercise details based on name and any voice instructions
-            if llm_provider == 'openai':
-                exercise_data = generate_exercise_with_openai(exercise_name, voice_instructions)
-            else:  # Default to Claude
-                exercise_data = generate_exercise_with_claude(exercise_name, voice_instructions)
-        
-        # 2. Generate a new ID for this custom exercise
+        # 1. Generate a new ID for this custom exercise
         exercise_id = str(uuid.uuid4())
-        exercise_data['id'] = exercise_id
+        now = datetime.now()
         
-        # 3. If a custom video was provided, upload it to Cloud Storage
-        video_url = None
-        if custom_video and 'base64_data' in custom_video:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # 2. If a custom video was provided, upload it to Cloud Storage in the
+            # background while the exercise details are looked up or generated
+            upload_future = None
+            if custom_video and 'base64_data' in custom_video:
+                upload_future = executor.submit(upload_custom_video, custom_video, exercise_id, patient_id)
+            
             try:
-                # Get video data
-                video_data = base64.b64decode(custom_video['base64_data'])
-                content_type = custom_video.get('content_type', 'video/mp4')
-                filename = custom_video.get('filename', f'{exercise_id}-{patient_id}.mp4')
-                
-                # Create a unique filename to avoid collisions
-                blob_name = f"exercise-videos/{patient_id}/{exercise_id}/{uuid.uuid4()}-{filename}"
+                # 3. Check if a similar exercise already exists
+                existing_exercise = find_exercise_by_name(exercise_name)
                 
-                # Get the bucket
-                bucket = storage_client.bucket(bucket_name)
-                # Create a new blob
-                blob = bucket.blob(blob_name)
-                # Upload the video
-                blob.upload_from_string(video_data, content_type=content_type)
-                
-                # Make the blob publicly readable
-                blob.make_public()
-                
-                # Get the public URL
-                video_url = blob.public_url
-                
-            except Exception as e:
-                return (json.dumps({'error': f'Error uploading video: {str(e)}'}, cls=DateTimeEncoder), 500, headers)
+                if existing_exercise:
+                    # Use existing exercise as a starting point
+                    exercise_data = existing_exercise.copy()
+                    exercise_data['original_exercise_id'] = existing_exercise['id']
+                elif upload_future and upload_future.done() and upload_future.exception():
+                    # The upload already failed, so don't pay for generating the exercise
+                    return (orjson.dumps({'error': f'Error uploading video: {str(upload_future.exception())}'}, default=json_default), 500, headers)
+                else:
+                    # Use LLM to generate exercise details based on name and any voice instructions
+                    if llm_provider == 'openai':
+                        exercise_data = generate_exercise_with_openai(exercise_name, voice_instructions)
+                    else:  # Default to Claude
+                        exercise_data = generate_exercise_with_claude(exercise_name, voice_instructions)
+            except Exception:
+                # Don't leave the uploaded video behind without an exercise
+                discard_uploaded_video(upload_future)
+                raise
+            
+            exercise_data['id'] = exercise_id
+            
+            # Wait for the video upload to finish
+            video_url = None
+            if upload_future:
+                try:
+                    video_url = upload_future.result().public_url
+                except Exception as e:
+                    return (orjson.dumps({'error': f'Error uploading video: {str(e)}'}, default=json_default), 500, headers)
         
         # 4. Update exercise data with video URL and metadata
         exercise_data.update({
             'video_url': video_url if video_url else exercise_data.get('video_url', ''),
             'is_template': False,
             'source': 'pt-created',
-            'created_at': datetime.now(),
+            'created_at': now,
             'created_by': pt_id
         })
         
-        # 5. Save the exercise to Firestore
-        db.collection('exercises').document(exercise_id).set(exercise_data)
+        # 5. Save the exercise, its name index entry and the patient link in one atomic batch
+        batch = db.batch()
+        batch.set(db.collection('exercises').document(exercise_id), exercise_data)
+        
+        # Index newly generated exercises by name so later lookups are point reads
+        name_key = exercise_name_key(exercise_name)
+        if not existing_exercise and name_key:
+            batch.set(db.collection('exercises_by_name').document(name_key), {
+                'exercise_id': exercise_id,
+                'name': exercise_name
+            })
         
         # 6. Create patient-exercise link
         patient_exercise_id = str(uuid.uuid4())
@@ -143,7 +279,7 @@ def add_custom_exercise(request):
             'id': patient_exercise_id,
             'patient_id': patient_id,
             'exercise_id': exercise_id,
-            'recommended_at': datetime.now(),
+            'recommended_at': now,
             'pt_modified': True,
             'pt_id': pt_id,
             'frequency': 'daily',  # Default
@@ -151,7 +287,14 @@ def add_custom_exercise(request):
             'repetitions': 10      # Default
         }
         
-        db.collection('patient_exercises').document(patient_exercise_id).set(patient_exercise)
+        # Embed a copy of the exercise so the patient's assignments can be read back
+        # without a second lookup in the exercises collection
+        batch.set(db.collection('patient_exercises').document(patient_exercise_id), {**patient_exercise, 'exercise': exercise_data})
+        try:
+            batch.commit()
+        except Exception:
+            discard_uploaded_video(upload_future)
+            raise
         
         # 7. Return success response
         response = {
@@ -161,52 +304,132 @@ def add_custom_exercise(request):
             'message': 'Custom exercise successfully added'
         }
         
-        return (json.dumps(response, cls=DateTimeEncoder), 200, headers)
+        return (orjson.dumps(response, default=json_default), 200, headers)
         
     except Exception as e:
-        return (json.dumps({'error': f'Error adding custom exercise: {str(e)}'}, cls=DateTimeEncoder), 500, headers)
+        return (orjson.dumps({'error': f'Error adding custom exercise: {str(e)}'}, default=json_default), 500, headers)
 
 
-def generate_exercise_with_claude(exercise_name, voice_instructions=""):
+def upload_custom_video(custom_video, exercise_id, patient_id):
     """
-    Generate exercise details using Anthropic's Claude API
+    Upload a base64-encoded custom video to Cloud Storage and return its public blob
     """
-    # Get API key from Secret Manager
-    api_key = access_secret_version("anthropic-api-key")
+    # Get video data
+    video_data = base64.b64decode(custom_video['base64_data'])
+    content_type = custom_video.get('content_type', 'video/mp4')
+    filename = custom_video.get('filename', f'{exercise_id}-{patient_id}.mp4')
     
-    # Construct prompt for Claude
-    prompt = f"""
-    I need detailed information about a knee rehabilitation exercise called "{exercise_name}".
+    # Create a unique filename to avoid collisions
+    blob_name = f"exercise-videos/{patient_id}/{exercise_id}/{uuid.uuid4()}-{filename}"
     
-    Additional instructions from the physical therapist:
-    {voice_instructions}
+    # Get the bucket
+    bucket = storage_client.bucket(bucket_name)
+    # Create a new blob
+    blob = bucket.blob(blob_name, chunk_size=VIDEO_UPLOAD_CHUNK_SIZE)
+    # Upload the video straight from the decoded buffer
+    blob.upload_from_file(io.BytesIO(video_data), size=len(video_data), content_type=content_type)
     
-    Please provide:
-    1. A concise description of the exercise
-    2. Target joints it affects
-    3. Step-by-step instructions
-    4. A URL for a representative video if you know of one
+    # Make the blob publicly readable, unless the bucket already grants public read
+    if not VIDEO_BUCKET_UNIFORM_ACCESS:
+        blob.make_public()
     
-    Format your response as JSON according to this structure:
-    ```json
-    {{
-      "name": "{exercise_name}",
-      "description": "Brief description of the exercise",
-      "target_joints": ["knee", "ankle"],
-      "instructions": [
-        "Step 1",
-        "Step 2",
-        "Step 3"
-      ],
-      "video_url": "https://example.com/video.mp4"
-    }}
-    ```
+    return blob
+
+
+def discard_uploaded_video(upload_future):
+    """
+    Wait for a background video upload and delete the uploaded video, if any
+    """
+    if upload_future is None:
+        return
     
-    Respond ONLY with the JSON object and nothing else.
+    try:
+        blob = upload_future.result()
+    except Exception:
+        # Nothing was uploaded
+        return
+    
+    try:
+        blob.delete()
+    except Exception as e:
+        print(f"Error deleting orphaned video {blob.name}: {str(e)}")
+
+
+def normalize_exercise_name(name):
+    """
+    Lowercase an exercise name and collapse its whitespace. Shared with
+    generate_exercises, which derives exercise IDs the same way
+    """
+    return ' '.join((name or '').lower().split())
+
+
+def exercise_name_key(exercise_name):
+    """
+    Return the exercises_by_name document ID for an exercise name. This is the
+    same name-based uuid5 that generate_exercises uses as the exercise ID
+    """
+    normalized_name = normalize_exercise_name(exercise_name)
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, normalized_name)) if normalized_name else None
+
+
+def find_exercise_by_name(exercise_name):
+    """
+    Find an existing exercise by name using the exercises_by_name index.
+    Exercises created before the index existed are found with a name query
+    and backfilled into the index.
+    """
+    name_key = exercise_name_key(exercise_name)
+    
+    if name_key:
+        index_doc = db.collection('exercises_by_name').document(name_key).get()
+        if index_doc.exists:
+            ex_doc = db.collection('exercises').document(index_doc.to_dict()['exercise_id']).get()
+            if ex_doc.exists:
+                return ex_doc.to_dict()
+    
+    similar_exercises = db.collection('exercises').where('name', '==', exercise_name).limit(1).get()
+    
+    if len(similar_exercises) == 0:
+        return None
+    
+    if name_key:
+        db.collection('exercises_by_name').document(name_key).set({
+            'exercise_id': similar_exercises[0].id,
+            'name': exercise_name
+        })
+    
+    return similar_exercises[0].to_dict()
+
+
+def extract_json_block(content):
+    """
+    Return the body of the first fenced ```json block in an LLM response,
+    or the whole response if it has no such block
     """
+    start = content.find(JSON_FENCE)
+    if start == -1:
+        return content  # Assume the content is just JSON
+    
+    start += len(JSON_FENCE)
+    end = content.find('```', start)
+    if end == -1:
+        return content
+    
+    return content[start:end].strip()
+
+
+def generate_exercise_with_claude(exercise_name, voice_instructions=""):
+    """
+    Generate exercise details using Anthropic's Claude API
+    """
+    # Get API key from Secret Manager
+    api_key = access_secret_version("anthropic-api-key")
+    
+    # Construct prompt for Claude
+    prompt = CLAUDE_EXERCISE_PROMPT.format(exercise_name=exercise_name, voice_instructions=voice_instructions)
     
     # Call Claude API
-    response = requests.post(
+    response = get_http_session().post(
         "https://api.anthropic.com/v1/messages",
         headers={
             "x-api-key": api_key,
@@ -214,14 +437,17 @@ def generate_exercise_with_claude(exercise_name, voice_instructions=""):
             "content-type": "application/json"
         },
         json={
-            "model": "claude-3-opus-20240229",
-            "max_tokens": 1000,
+            "model": CLAUDE_MODEL,
+            "max_tokens": LLM_MAX_TOKENS,
             "temperature": 0.3,
-            "system": "You are a senior physical therapist specializing in knee rehabilitation.",
+            "system": [
+                {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+            ],
             "messages": [
                 {"role": "user", "content": prompt}
             ]
-        }
+        },
+        timeout=LLM_REQUEST_TIMEOUT
     )
     
     # Parse response
@@ -232,15 +458,7 @@ def generate_exercise_with_claude(exercise_name, voice_instructions=""):
     content = result.get('content', [{}])[0].get('text', '{}')
     
     # Extract JSON from the response
-    import re
-    json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL)
-    
-    if json_match:
-        exercise_json = json_match.group(1)
-    else:
-        exercise_json = content  # Assume the content is just JSON
-    
-    exercise = json.loads(exercise_json)
+    exercise = orjson.loads(extract_json_block(content))
     
     # Ensure target_joints is a list
     if isinstance(exercise.get('target_joints', []), str):
@@ -261,50 +479,25 @@ def generate_exercise_with_openai(exercise_name, voice_instructions=""):
     api_key = access_secret_version("openai-api-key")
     
     # Construct prompt similar to Claude version
-    prompt = f"""
-    I need detailed information about a knee rehabilitation exercise called "{exercise_name}".
-    
-    Additional instructions from the physical therapist:
-    {voice_instructions}
-    
-    Please provide:
-    1. A concise description of the exercise
-    2. Target joints it affects
-    3. Step-by-step instructions
-    4. A URL for a representative video if you know of one
-    
-    Format your response as JSON according to this structure:
-    {{
-      "name": "{exercise_name}",
-      "description": "Brief description of the exercise",
-      "target_joints": ["knee", "ankle"],
-      "instructions": [
-        "Step 1",
-        "Step 2",
-        "Step 3"
-      ],
-      "video_url": "https://example.com/video.mp4"
-    }}
-    
-    Respond ONLY with the JSON object and nothing else.
-    """
+    prompt = OPENAI_EXERCISE_PROMPT.format(exercise_name=exercise_name, voice_instructions=voice_instructions)
     
     # Call OpenAI API
-    response = requests.post(
+    response = get_http_session().post(
         "https://api.openai.com/v1/chat/completions",
         headers={
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         },
         json={
-            "model": "gpt-4",
+            "model": OPENAI_MODEL,
             "messages": [
-                {"role": "system", "content": "You are a senior physical therapist specializing in knee rehabilitation."},
+                {"role": "system", "content": SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
             "temperature": 0.3,
-            "max_tokens": 1000
-        }
+            "max_tokens": LLM_MAX_TOKENS
+        },
+        timeout=LLM_REQUEST_TIMEOUT
     )
     
     # Parse response
@@ -314,7 +507,7 @@ def generate_exercise_with_openai(exercise_name, voice_instructions=""):
     result = response.json()
     content = result.get('choices', [{}])[0].get('message', {}).get('content', '{}')
     
-    exercise = json.loads(content)
+    exercise = orjson.loads(content)
     
     # Ensure target_joints is a list
     if isinstance(exercise.get('target_joints', []), str):
@@ -2,11 +2,23 @@ from google.cloud import firestore
 import uuid
 from datetime import datetime
 
+# Firestore client, created on first use and shared by later calls
+db = None
+
+def get_db():
+    """
+    Return the shared Firestore client, creating it on first use
+    """
+    global db
+    if db is None:
+        db = firestore.Client()
+    return db
+
 def init_firestore_db():
     """
     Creates Firestore database structure (collections and example documents)
     """
-    db = firestore.Client()
+    db = get_db()
     
     # Define the database schema - Firestore is NoSQL but we'll define expected fields
     
@@ -48,6 +60,38 @@ def init_firestore_db():
         "source": "llm-generated"  # or "pt-created", "system-template"
     }
     
+    # Example document for template_exercises collection
+    # Denormalized copy of each is_template exercise; document ID is the exercise ID.
+    # Populated by backfill_template_exercises (python db_schema.py)
+    template_exercise_schema = dict(exercise_schema)
+    
+    # Example document for exercises_by_name collection (name index)
+    # Document ID is the uuid5 (NAMESPACE_URL) of the lowercased, whitespace-collapsed
+    # name, the same ID generate_exercises gives an LLM-generated exercise
+    exercise_by_name_schema = {
+        "exercise_id": "exercise-uuid-reference",
+        "name": "Knee Flexion"
+    }
+    
+    # Example document for llm_exercise_cache collection
+    # Document ID is a hash of the patient profile used to prompt the LLM
+    llm_exercise_cache_schema = {
+        "exercises": [exercise_schema],  # Raw LLM output, before videos are added
+        "created_at": datetime.now()
+    }
+    
+    # Example document for video_cache collection
+    # Document ID is an MD5 hash of the normalized search query
+    video_cache_schema = {
+        "query": "knee flexion physical therapy exercise",
+        "video": {
+            "title": "Knee Flexion Exercise",
+            "video_url": "https://www.youtube.com/watch?v=video-id",
+            "thumbnail": "https://img.youtube.com/vi/video-id/hqdefault.jpg"
+        },
+        "created_at": datetime.now()
+    }
+    
     # Example document for patient_exercises collection (junction table)
     patient_exercise_schema = {
         "id": "uuid-string",
@@ -59,7 +103,8 @@ def init_firestore_db():
         "frequency": "daily",
         "sets": 3,
         "repetitions": 10,
-        "notes": "Start with lower intensity if knee feels stiff"
+        "notes": "Start with lower intensity if knee feels stiff",
+        "exercise": exercise_schema  # Copy of the exercise, so assignments read back in one query
     }
     
     # Example document for exercise_sessions collection (tracking completed exercises)
@@ -95,5 +140,42 @@ def init_firestore_db():
         "created_at": datetime.now()
     }
     
+    # Composite indexes required by the queries in the cloud functions (such as
+    # generate_report's recent reports for a patient, newest first) are defined in
+    # firestore.indexes.json; deploy them from this directory with
+    #   firebase deploy --only firestore:indexes
+    # Equality-only queries are served by Firestore's automatic single-field indexes
+    
     print("Firestore database schema defined")
-    return db
\ No newline at end of file
+    return db
+
+def backfill_template_exercises():
+    """
+    Copy every exercise flagged is_template into the template_exercises collection,
+    keyed by exercise ID. Re-run whenever template exercises are added or edited
+    """
+    db = get_db()
+    batch = db.batch()
+    pending = 0
+    copied = 0
+    
+    for doc in db.collection('exercises').where('is_template', '==', True).stream():
+        batch.set(db.collection('template_exercises').document(doc.id), doc.to_dict())
+        pending += 1
+        copied += 1
+        
+        # Firestore batches are limited to 500 writes
+        if pending == 500:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    
+    if pending:
+        batch.commit()
+    
+    print(f"Copied {copied} template exercises")
+    return copied
+
+
+if __name__ == '__main__':
+    backfill_template_exercises()
@@ -1,56 +1,234 @@
 import functions_framework
 import json
+import orjson
 import uuid
 import os
 import requests
-import re
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import hashlib
+import re
+import threading
+from functools import lru_cache
+from collections import OrderedDict
 from google.cloud import firestore
 from google.cloud import secretmanager
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('generate_exercises')
 
-# Custom JSON encoder to handle datetime objects
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super(DateTimeEncoder, self).default(obj)
+# Fallback for orjson, which only serializes plain datetime objects natively
+def json_default(obj):
+    # Handle datetime subclasses such as Firestore's DatetimeWithNanoseconds
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+# Secret Manager setup (client is created on first use)
+secret_client = None
+secret_client_lock = threading.Lock()
+
+def get_secret_client():
+    """
+    Return the shared Secret Manager client, creating it on first use
+    """
+    global secret_client
+    if secret_client is None:
+        # get_api_keys looks up secrets from several threads at once
+        with secret_client_lock:
+            if secret_client is None:
+                secret_client = secretmanager.SecretManagerServiceClient()
+    return secret_client
 
-# Secret Manager setup
+@lru_cache(maxsize=8)
 def access_secret_version(secret_id, version_id="latest"):
     """
-    Access the secret from GCP Secret Manager
+    Access the secret from GCP Secret Manager. Results are cached for the life
+    of the instance; failed lookups are not cached.
     """
     try:
-        client = secretmanager.SecretManagerServiceClient()
         name = f"projects/{os.environ['PROJECT_ID']}/secrets/{secret_id}/versions/{version_id}"
-        response = client.access_secret_version(request={"name": name})
+        response = get_secret_client().access_secret_version(request={"name": name})
         # Strip whitespace and newlines to avoid issues with API keys
         return response.payload.data.decode("UTF-8").strip()
     except Exception as e:
         logger.error(f"Error accessing secret '{secret_id}': {str(e)}")
         raise
 
-# Initialize Firestore DB (default)
-db = firestore.Client()
+# Firestore DB (default), created on first use so CORS preflights and invalid
+# requests return without paying for client setup
+db = None
+db_lock = threading.Lock()
+
+def get_db():
+    """
+    Return the shared Firestore client, creating it on first use
+    """
+    global db
+    if db is None:
+        # Worker threads can ask for the client at the same time on a cold instance
+        with db_lock:
+            if db is None:
+                db = firestore.Client()
+    return db
+
+# Shared HTTP session so warm instances reuse TLS connections to the LLM and Google APIs.
+# Only the idempotent Google GETs are retried on read errors and error statuses; the
+# billed LLM POSTs are only retried when the connection could not be made. Backoff is
+# capped and Retry-After ignored to keep the total wait bounded
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.2,
+        backoff_max=5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(['GET']),
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+))
+
+# System prompt shared by the Claude and OpenAI exercise generators
+SYSTEM_PROMPT = "You are a senior physical therapist specializing in knee rehabilitation."
+
+# Fixed exercise-generation instructions, sent ahead of the patient profile so
+# every request shares the same prompt prefix
+EXERCISE_INSTRUCTIONS = """
+Generate personalized knee rehabilitation exercises for the patient whose profile is given in the user message.
+
+Please provide 3-5 evidence-based exercises appropriate for knee rehabilitation for this specific patient.
+Consider standard physical therapy protocols and clinical practice guidelines.
+
+For each exercise, include:
+1. A clear name
+2. A concise description
+3. Target joints (list)
+4. Step-by-step instructions (list)
+
+DO NOT include video URLs or links. I will add them separately.
+
+Return the exercises by calling the emit_exercises tool.
+"""
+
+# Structured output schema for the emit_exercises tool. Both providers are forced
+# to call the tool, so the streamed arguments are always this JSON object
+EXERCISES_TOOL_NAME = "emit_exercises"
+EXERCISES_TOOL_DESCRIPTION = "Return the generated knee rehabilitation exercises."
+EXERCISES_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "exercises": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "description": {"type": "string"},
+                    "target_joints": {"type": "array", "items": {"type": "string"}},
+                    "instructions": {"type": "array", "items": {"type": "string"}}
+                },
+                "required": ["name", "description", "target_joints", "instructions"]
+            }
+        }
+    },
+    "required": ["exercises"]
+}
+OPENAI_SYSTEM_PROMPT = SYSTEM_PROMPT + "\n" + EXERCISE_INSTRUCTIONS
+
+# Per-patient part of the exercise-generation prompt
+PATIENT_PROMPT = """
+Patient profile:
+
+Name: {name}
+Age: {age}
+Exercise frequency: {frequency}
+{pain_points_text}
+"""
+
+# Models by (provider, quality). Exercise generation is a small structured-output
+# task, so the fast tiers are the default and requests can opt in to the larger
+# models with "quality": "high". Each model can be overridden per deployment
+LLM_MODELS = {
+    ('claude', 'standard'): os.environ.get('CLAUDE_MODEL', 'claude-3-5-haiku-20241022'),
+    ('claude', 'high'): os.environ.get('CLAUDE_HIGH_QUALITY_MODEL', 'claude-sonnet-4-5-20250929'),
+    ('openai', 'standard'): os.environ.get('OPENAI_MODEL', 'gpt-4o-mini'),
+    ('openai', 'high'): os.environ.get('OPENAI_HIGH_QUALITY_MODEL', 'gpt-4')
+}
+# 1200 output tokens leaves headroom for five exercises with step-by-step instructions
+LLM_MAX_TOKENS = 1200
+
+# (connect, read) timeout in seconds for LLM requests
+LLM_REQUEST_TIMEOUT = (10, 60)
+
+# Maximum number of operations Firestore accepts in a single WriteBatch
+FIRESTORE_BATCH_LIMIT = 500
+# Maximum number of WriteBatches committed concurrently for large write sets
+FIRESTORE_COMMIT_WORKERS = 8
+
+# Captures the video ID from youtube.com/watch?v= and youtu.be/ links
+YOUTUBE_VIDEO_ID_RE = re.compile(r'(?:youtube\.com/watch\?v=|youtu\.be/)([A-Za-z0-9_-]{11})')
+
+# (connect, read) timeout in seconds for video validation requests
+VIDEO_VALIDATION_TIMEOUT = (3, 5)
+
+# Maximum number of concurrent video searches per request
+VIDEO_SEARCH_WORKERS = 8
+
+# Pain point fields used by the LLM prompt and cache key; queries project to these
+PAIN_POINT_FIELDS = ['description', 'severity']
+
+# How long LLM-generated exercises are reused for patients with the same profile
+LLM_CACHE_TTL = timedelta(days=30)
+
+# Commit Firestore writes on a background thread after the response is returned.
+# Only enable where CPU stays allocated after a response (Cloud Functions gen2 or
+# Cloud Run with CPU always allocated); otherwise the writes may never finish
+BACKGROUND_WRITES = os.environ.get('BACKGROUND_WRITES', 'false').lower() == 'true'
+
+# Validate freshly searched videos on a background thread after the exercises are
+# saved, replacing dead ones in Firestore, instead of before responding. This is a
+# best-effort repair, so it is on by default; set to false to validate inline
+BACKGROUND_VIDEO_VALIDATION = os.environ.get('BACKGROUND_VIDEO_VALIDATION', 'true').lower() == 'true'
+
+# How long video search results are reused, per instance and in video_cache
+VIDEO_CACHE_TTL = timedelta(days=7)
+# Most video searches an instance keeps in memory; the least recently used are evicted first
+VIDEO_CACHE_MAX_ENTRIES = 500
+# Per-instance video search results: cache key -> (result, cached_at), in LRU order
+video_search_cache = OrderedDict()
+video_search_cache_lock = threading.Lock()
+
+# Fewest saved or template exercises served instead of generating a new set
+MIN_EXERCISES = 3
+
+# In-memory snapshot of template exercises, refreshed after TEMPLATE_CACHE_TTL
+TEMPLATE_CACHE_TTL = timedelta(minutes=10)
+template_cache = {'exercises': None, 'loaded_at': None}
 
 # Function to get API keys from Secret Manager
 def get_api_keys():
     """
     Get all required API keys from Secret Manager
     """
-    keys = {
-        'google_api_key': access_secret_version("google-api-key"),
-        'google_cse_id': access_secret_version("google-cse-id"),
-        'anthropic_api_key': access_secret_version("anthropic-api-key"),
-        'openai_api_key': access_secret_version("openai-api-key")
+    secret_ids = {
+        'google_api_key': "google-api-key",
+        'google_cse_id': "google-cse-id",
+        'anthropic_api_key': "anthropic-api-key",
+        'openai_api_key': "openai-api-key"
     }
     
+    # The lookups are independent, so a cold instance fetches them concurrently
+    with ThreadPoolExecutor(max_workers=len(secret_ids)) as executor:
+        keys = dict(zip(secret_ids, executor.map(access_secret_version, secret_ids.values())))
+    
     # Verify we have the required keys
     if not keys['google_api_key'] or not keys['google_cse_id']:
         logger.error("Missing required Google API keys")
@@ -67,7 +245,8 @@ def generate_exercises(request):
     Request format:
     {
         "patient_id": "uuid-of-patient",
-        "llm_provider": "claude" or "openai"
+        "llm_provider": "claude" or "openai",
+        "quality": "standard" (default) or "high"
     }
     """
     # Enable CORS
@@ -86,70 +265,108 @@ def generate_exercises(request):
         request_json = request.get_json(silent=True)
         
         if not request_json or 'patient_id' not in request_json:
-            return (json.dumps({'error': 'Invalid request - missing patient_id'}, cls=DateTimeEncoder), 400, headers)
+            return (orjson.dumps({'error': 'Invalid request - missing patient_id'}, default=json_default), 400, headers)
         
         patient_id = request_json['patient_id']
         llm_provider = request_json.get('llm_provider', 'claude')  # Default to Claude if not specified
+        quality = 'high' if request_json.get('quality') == 'high' else 'standard'
+        llm_model = LLM_MODELS[('openai' if llm_provider == 'openai' else 'claude', quality)]
         
-        logger.info(f"Processing request for patient_id: {patient_id}, llm_provider: {llm_provider}")
+        logger.info(f"Processing request for patient_id: {patient_id}, llm_provider: {llm_provider}, model: {llm_model}")
         
-        # Get all API keys from Secret Manager once at the beginning
-        api_keys = get_api_keys()
+        # Get all API keys from Secret Manager. They are only needed once exercises
+        # have to be generated, so fetch them while Firestore is being checked
+        key_executor = ThreadPoolExecutor(max_workers=1)
+        api_keys_future = key_executor.submit(get_api_keys)
+        key_executor.shutdown(wait=False)
         
         # 1. First, check if suitable exercises already exist in the database
-        existing_exercises = check_existing_exercises(patient_id)
+        existing_exercises, pain_points = check_existing_exercises(patient_id)
         
-        if existing_exercises and len(existing_exercises) >= 3:
+        if existing_exercises and len(existing_exercises) >= MIN_EXERCISES:
             logger.info(f"Found {len(existing_exercises)} existing exercises for patient")
             
-            # Debug: Validate existing video links
-            for exercise in existing_exercises:
-                video_url = exercise.get('video_url', '')
-                if video_url:
-                    logger.info(f"Existing exercise '{exercise['name']}' has video URL: {video_url}")
-                    validate_video_url(video_url, exercise['name'])
+            # Debug: Validate existing video links. Results are only logged, so this
+            # runs in the background instead of holding up the response
+            run_in_background(validate_exercise_videos, list(existing_exercises))
             
             # Make sure existing exercises have video thumbnails
             for exercise in existing_exercises:
                 if not exercise.get('video_thumbnail') and exercise.get('video_url'):
                     exercise['video_thumbnail'] = get_video_thumbnail(exercise['video_url'])
             
-            return (json.dumps({
+            return (orjson.dumps({
                 'status': 'success', 
                 'exercises': existing_exercises,
                 'source': 'database'
-            }, cls=DateTimeEncoder), 200, headers)
+            }, default=json_default), 200, headers)
         
         # 2. If not enough existing exercises, get patient data
-        patient_data = get_patient_data(patient_id)
+        patient_data = get_patient_data(patient_id, preloaded_pain_points=pain_points)
         if not patient_data:
             logger.warning(f"Patient not found: {patient_id}")
-            return (json.dumps({'error': 'Patient not found'}, cls=DateTimeEncoder), 404, headers)
+            return (orjson.dumps({'error': 'Patient not found'}, default=json_default), 404, headers)
         
-        # 3. Generate exercises using LLM (without video URLs)
-        if llm_provider == 'openai':
-            exercises = generate_exercises_with_openai(patient_data, api_keys['openai_api_key'])
+        # Without pain points there is nothing to personalize, so serve the
+        # templates instead of waiting on the LLM
+        if not patient_data.get('pain_points'):
+            template_exercises = get_template_exercises()
+            
+            if len(template_exercises) >= MIN_EXERCISES:
+                logger.info(f"No pain points for patient, returning {len(template_exercises)} template exercises")
+                
+                for exercise in template_exercises:
+                    if not exercise.get('video_thumbnail') and exercise.get('video_url'):
+                        exercise['video_thumbnail'] = get_video_thumbnail(exercise['video_url'])
+                
+                return (orjson.dumps({
+                    'status': 'success',
+                    'exercises': template_exercises,
+                    'source': 'database'
+                }, default=json_default), 200, headers)
+        
+        api_keys = api_keys_future.result()
+        
+        # 3. Generate exercises using LLM (without video URLs), reusing the output
+        # for an earlier patient with the same profile when available
+        cache_key = llm_cache_key(patient_data, llm_provider, llm_model)
+        cached_exercises = get_cached_llm_exercises(cache_key)
+        generated_exercises = []
+        
+        if cached_exercises:
+            logger.info(f"Using {len(cached_exercises)} cached {llm_provider} exercises")
+            exercise_stream = cached_exercises
+        elif llm_provider == 'openai':
+            exercise_stream = collect_into(generate_exercises_with_openai(patient_data, api_keys['openai_api_key'], llm_model), generated_exercises)
         else:  # Default to Claude
-            exercises = generate_exercises_with_claude(patient_data, api_keys['anthropic_api_key'])
+            exercise_stream = collect_into(generate_exercises_with_claude(patient_data, api_keys['anthropic_api_key'], llm_model), generated_exercises)
         
-        logger.info(f"Generated {len(exercises)} exercises using {llm_provider}")
+        # 4. Enhance exercises with real video URLs and thumbnails. LLM output is
+        # streamed, so each video search starts while later exercises are still generating
+        enhanced_exercises = enhance_exercises_with_videos(exercise_stream, api_keys['google_api_key'], api_keys['google_cse_id'])
         
-        # 4. Enhance exercises with real video URLs and thumbnails
-        enhanced_exercises = enhance_exercises_with_videos(exercises, api_keys['google_api_key'], api_keys['google_cse_id'])
+        if generated_exercises:
+            logger.info(f"Generated {len(generated_exercises)} exercises using {llm_provider}")
+            run_write(cache_llm_exercises, cache_key, generated_exercises)
         
-        # 5. Save the generated exercises to Firestore
-        saved_exercises = save_exercises(enhanced_exercises, patient_id)
+        # 5. Save the generated exercises to Firestore. With background validation the
+        # videos were not checked during the search, so check them once the exercises
+        # are stored
+        after_commit = None
+        if BACKGROUND_VIDEO_VALIDATION:
+            after_commit = lambda exercises: run_in_background(revalidate_videos, exercises, api_keys['google_api_key'], api_keys['google_cse_id'])
+        saved_exercises = save_exercises(enhanced_exercises, patient_id, after_commit=after_commit)
         
         # 6. Return the exercises
-        return (json.dumps({
+        return (orjson.dumps({
             'status': 'success',
             'exercises': saved_exercises,
             'source': 'llm-generated'
-        }, cls=DateTimeEncoder), 200, headers)
+        }, default=json_default), 200, headers)
         
     except Exception as e:
         logger.error(f"Error generating exercises: {str(e)}", exc_info=True)
-        return (json.dumps({'error': f'Error generating exercises: {str(e)}'}, cls=DateTimeEncoder), 500, headers)
+        return (orjson.dumps({'error': f'Error generating exercises: {str(e)}'}, default=json_default), 500, headers)
 
 
 def validate_video_url(url, exercise_name):
@@ -159,11 +376,7 @@ def validate_video_url(url, exercise_name):
     try:
         if 'youtube.com' in url or 'youtu.be' in url:
             # Extract video ID
-            video_id = None
-            if 'youtube.com/watch?v=' in url:
-                video_id = url.split('youtube.com/watch?v=')[1].split('&')[0]
-            elif 'youtu.be/' in url:
-                video_id = url.split('youtu.be/')[1].split('?')[0]
+            video_id = extract_youtube_video_id(url)
             
             if not video_id:
                 logger.warning(f"Could not extract video ID from URL: {url}")
@@ -171,7 +384,7 @@ def validate_video_url(url, exercise_name):
                 
             # Check video info via oEmbed API (lightweight way to validate)
             oembed_url = f"https://www.youtube.com/oembed?url=https://www.youtube.com/watch?v={video_id}&format=json"
-            response = requests.get(oembed_url)
+            response = http_session.get(oembed_url, timeout=VIDEO_VALIDATION_TIMEOUT)
             
             if response.status_code == 200:
                 logger.info(f"✅ Video for '{exercise_name}' is valid: {url}")
@@ -185,120 +398,195 @@ def validate_video_url(url, exercise_name):
     return False
 
 
+def validate_exercise_videos(exercises):
+    """
+    Validate the video URLs of several exercises concurrently
+    """
+    exercises_with_video = [exercise for exercise in exercises if exercise.get('video_url')]
+    if not exercises_with_video:
+        return
+    
+    for exercise in exercises_with_video:
+        logger.info(f"Existing exercise '{exercise['name']}' has video URL: {exercise['video_url']}")
+    
+    with ThreadPoolExecutor(max_workers=min(len(exercises_with_video), VIDEO_SEARCH_WORKERS)) as executor:
+        for exercise in exercises_with_video:
+            executor.submit(validate_video_url, exercise['video_url'], exercise['name'])
+
+
 def check_existing_exercises(patient_id):
     """
     Check if suitable exercises already exist in the database for this patient
-    or similar patients with matching pain points
-    """
-    # First check if this patient already has assigned exercises
-    existing_assignments = db.collection('patient_exercises').where('patient_id', '==', patient_id).get()
+    or similar patients with matching pain points.
     
-    if len(existing_assignments) > 0:
-        # Patient has existing exercise assignments, fetch those exercise details
-        existing_exercise_ids = [doc.to_dict()['exercise_id'] for doc in existing_assignments]
-        exercises = []
+    Returns (exercises, pain_points).
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # The pain points are needed on every path except the first, so read them
+        # while the patient's assignments are being fetched
+        pain_points_future = executor.submit(get_pain_points, patient_id)
+        
+        # First check if this patient already has assigned exercises. Assignments embed
+        # a copy of their exercise, so usually this one query returns everything
+        assignments = [
+            doc.to_dict()
+            for doc in get_db().collection('patient_exercises').where('patient_id', '==', patient_id).select(['exercise_id', 'exercise']).stream()
+        ]
+        
+        # Older assignments only store the exercise ID; fetch those exercises in a
+        # single batched read
+        missing_ids = [a['exercise_id'] for a in assignments if not a.get('exercise')]
+        exercise_docs = {}
+        if missing_ids:
+            exercise_refs = [get_db().collection('exercises').document(ex_id) for ex_id in dict.fromkeys(missing_ids)]
+            exercise_docs = {doc.id: doc.to_dict() for doc in get_db().get_all(exercise_refs) if doc.exists}
         
-        for ex_id in existing_exercise_ids:
-            ex_doc = db.collection('exercises').document(ex_id).get()
-            if ex_doc.exists:
-                ex_data = ex_doc.to_dict()
-                exercises.append(ex_data)
+        # get_all does not preserve order, so walk the assignments to keep it stable
+        exercises = []
+        for assignment in assignments:
+            exercise = assignment.get('exercise') or exercise_docs.get(assignment.get('exercise_id'))
+            if exercise:
+                exercises.append(exercise)
         
-        if len(exercises) >= 3:
-            return exercises
+        pain_points = pain_points_future.result()
     
-    # If not enough exercises found, look for similar patients
-    # Get this patient's pain points
-    pain_points = db.collection('pain_points').where('patient_id', '==', patient_id).get()
+    if len(exercises) >= MIN_EXERCISES:
+        return exercises, pain_points
     
+    # If not enough exercises found, look for similar patients
     if len(pain_points) == 0:
-        return []  # No pain points to compare
+        return [], pain_points  # No pain points to compare
     
     # For simplicity in this demo, we'll just return some template exercises
     # In a production app, you'd implement similarity matching logic here
-    template_exercises = db.collection('exercises').where('is_template', '==', True).limit(5).get()
+    return get_template_exercises(), pain_points
+
+
+def get_template_exercises():
+    """
+    Return up to five template exercises from an in-memory snapshot that is
+    reloaded from Firestore every TEMPLATE_CACHE_TTL
+    """
+    now = datetime.now()
+    
+    if template_cache['exercises'] is None or now - template_cache['loaded_at'] > TEMPLATE_CACHE_TTL:
+        # Templates are kept denormalized in their own small collection, so this is a
+        # plain collection read instead of a filtered scan over all exercises
+        template_exercises = [doc.to_dict() for doc in get_db().collection('template_exercises').limit(5).stream()]
+        
+        if len(template_exercises) == 0:
+            # Fall back to the flagged exercises until template_exercises is populated
+            template_exercises = [
+                doc.to_dict()
+                for doc in get_db().collection('exercises').where('is_template', '==', True).limit(5).stream()
+            ]
+        
+        template_cache['exercises'] = template_exercises
+        template_cache['loaded_at'] = now
     
-    return [doc.to_dict() for doc in template_exercises]
+    # Callers fill in missing fields, so hand out copies of the snapshot
+    return [dict(exercise) for exercise in template_cache['exercises']]
 
 
-def get_patient_data(patient_id):
+def get_patient_data(patient_id, preloaded_pain_points=None):
     """
-    Retrieve patient data and pain points from Firestore
+    Retrieve patient data and pain points from Firestore. Pain points already
+    read by check_existing_exercises can be passed in to skip the second query.
     """
-    # Get patient document
-    patient_doc = db.collection('patients').document(patient_id).get()
+    if preloaded_pain_points is not None:
+        patient_doc = get_db().collection('patients').document(patient_id).get()
+        pain_points = preloaded_pain_points
+    else:
+        # The two reads are independent, so run them concurrently
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pain_points_future = executor.submit(get_pain_points, patient_id)
+            patient_doc = get_db().collection('patients').document(patient_id).get()
+            pain_points = pain_points_future.result()
     
     if not patient_doc.exists:
         return None
     
     patient_data = patient_doc.to_dict()
-    
-    # Get patient's pain points
-    pain_points = db.collection('pain_points').where('patient_id', '==', patient_id).get()
-    patient_data['pain_points'] = [doc.to_dict() for doc in pain_points]
+    patient_data['pain_points'] = pain_points
     
     return patient_data
 
 
-def generate_exercises_with_claude(patient_data, api_key):
+def get_pain_points(patient_id):
+    """
+    Get a patient's pain points (only the fields used to build the prompt)
+    """
+    pain_points = get_db().collection('pain_points').where('patient_id', '==', patient_id).select(PAIN_POINT_FIELDS).stream()
+    return [doc.to_dict() for doc in pain_points]
+
+
+def llm_cache_key(patient_data, llm_provider, llm_model):
+    """
+    Build the llm_exercise_cache key from the parts of the patient profile that
+    shape the generated exercises
+    """
+    pain_points = sorted(
+        f"{pp.get('description', 'knee pain')} (severity: {pp.get('severity', 5)}/10)"
+        for pp in patient_data.get('pain_points', [])
+    )
+    age = patient_data.get('age')
+    
+    profile = {
+        'llm_provider': llm_provider,
+        'llm_model': llm_model,
+        'pain_points': pain_points,
+        'age_bucket': age // 10 if isinstance(age, int) else None,
+        'frequency': patient_data.get('exercise_frequency', 'daily')
+    }
+    return hashlib.sha1(json.dumps(profile, sort_keys=True).encode()).hexdigest()
+
+
+def get_cached_llm_exercises(cache_key):
+    """
+    Return cached LLM exercises for this key, or None if missing or stale
+    """
+    try:
+        cache_doc = get_db().collection('llm_exercise_cache').document(cache_key).get()
+        if not cache_doc.exists:
+            return None
+        
+        cached = cache_doc.to_dict()
+        created_at = cached.get('created_at')
+        if not created_at or datetime.now(timezone.utc) - created_at > LLM_CACHE_TTL:
+            return None
+        
+        return cached.get('exercises')
+    except Exception as e:
+        logger.warning(f"Error reading LLM exercise cache: {str(e)}")
+        return None
+
+
+def cache_llm_exercises(cache_key, exercises):
+    """
+    Store LLM-generated exercises for reuse by patients with the same profile
+    """
+    try:
+        get_db().collection('llm_exercise_cache').document(cache_key).set({
+            'exercises': exercises,
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+    except Exception as e:
+        logger.warning(f"Error writing LLM exercise cache: {str(e)}")
+
+
+def generate_exercises_with_claude(patient_data, api_key, model):
     """
     Generate exercises using Anthropic's Claude API
     (Modified to request exercises without video URLs)
     """
     try:
-        # Construct prompt for Claude
-        name = patient_data.get('name', 'the patient')
-        age = patient_data.get('age', 'unknown age')
-        frequency = patient_data.get('exercise_frequency', 'daily')
-        
-        pain_points_text = "No specific pain points mentioned."
-        if 'pain_points' in patient_data and len(patient_data['pain_points']) > 0:
-            pain_descriptions = [f"{pp.get('description', 'knee pain')} (severity: {pp.get('severity', 5)}/10)" 
-                               for pp in patient_data['pain_points']]
-            pain_points_text = "Pain points: " + "; ".join(pain_descriptions)
-        
-        prompt = f"""
-        I need to generate personalized knee rehabilitation exercises for a patient with the following profile:
-        
-        Name: {name}
-        Age: {age}
-        Exercise frequency: {frequency}
-        {pain_points_text}
-        
-        Please provide 3-5 evidence-based exercises appropriate for knee rehabilitation for this specific patient.
-        Consider standard physical therapy protocols and clinical practice guidelines.
-        
-        For each exercise, include:
-        1. A clear name
-        2. A concise description
-        3. Target joints (comma-separated list)
-        4. Step-by-step instructions (semicolon-separated list)
-        
-        DO NOT include video URLs or links. I will add them separately.
-        
-        Format your response as JSON according to this structure:
-        ```json
-        [
-          {{
-            "name": "Exercise Name",
-            "description": "Brief description of the exercise",
-            "target_joints": ["knee", "ankle"],
-            "instructions": [
-              "Step 1",
-              "Step 2",
-              "Step 3"
-            ]
-          }}
-        ]
-        ```
-        
-        Respond ONLY with the JSON array and nothing else.
-        """
+        # Only the patient profile varies per call
+        prompt = build_patient_prompt(patient_data)
         
         logger.info("Calling Claude API to generate exercises")
         
-        # Call Claude API
-        response = requests.post(
+        # Call Claude API, streaming the response
+        response = http_session.post(
             "https://api.anthropic.com/v1/messages",
             headers={
                 "x-api-key": api_key,
@@ -306,14 +594,26 @@ def generate_exercises_with_claude(patient_data, api_key):
                 "content-type": "application/json"
             },
             json={
-                "model": "claude-3-opus-20240229",
-                "max_tokens": 2000,
+                "model": model,
+                "max_tokens": LLM_MAX_TOKENS,
                 "temperature": 0.3,
-                "system": "You are a senior physical therapist specializing in knee rehabilitation.",
+                "stream": True,
+                "tools": [{
+                    "name": EXERCISES_TOOL_NAME,
+                    "description": EXERCISES_TOOL_DESCRIPTION,
+                    "input_schema": EXERCISES_SCHEMA
+                }],
+                "tool_choice": {"type": "tool", "name": EXERCISES_TOOL_NAME},
+                "system": [
+                    {"type": "text", "text": SYSTEM_PROMPT},
+                    {"type": "text", "text": EXERCISE_INSTRUCTIONS}
+                ],
                 "messages": [
                     {"role": "user", "content": prompt}
                 ]
-            }
+            },
+            stream=True,
+            timeout=LLM_REQUEST_TIMEOUT
         )
         
         # Parse response
@@ -321,97 +621,62 @@ def generate_exercises_with_claude(patient_data, api_key):
             logger.error(f"Claude API error: {response.text}")
             raise Exception(f"Claude API error: {response.text}")
         
-        result = response.json()
-        content = result.get('content', [{}])[0].get('text', '[]')
-        
-        # Extract JSON from the response
-        json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL)
-        
-        if json_match:
-            exercises_json = json_match.group(1)
-        else:
-            exercises_json = content  # Assume the content is just JSON
+        # Yield each exercise as soon as its JSON object has been generated
+        text_stream = iter_llm_stream_text(response, 'claude')
+        exercise_count = 0
+        for exercise in iter_json_array_objects(text_stream):
+            exercise_count += 1
+            yield exercise
         
-        exercises = json.loads(exercises_json)
-        logger.info(f"Claude generated {len(exercises)} exercises")
+        # Drain the trailing stream events so the connection returns to the pool
+        for _ in text_stream:
+            pass
         
-        return exercises
+        logger.info(f"Claude generated {exercise_count} exercises")
     except Exception as e:
         logger.error(f"Error in generate_exercises_with_claude: {str(e)}", exc_info=True)
         raise Exception(f"Error in generate_exercises_with_claude: {str(e)}")
 
 
-def generate_exercises_with_openai(patient_data, api_key):
+def generate_exercises_with_openai(patient_data, api_key, model):
     """
     Generate exercises using OpenAI's GPT API
     (Modified to request exercises without video URLs)
     """
     try:
-        # Construct prompt similarly to Claude version
-        name = patient_data.get('name', 'the patient')
-        age = patient_data.get('age', 'unknown age')
-        frequency = patient_data.get('exercise_frequency', 'daily')
-        
-        pain_points_text = "No specific pain points mentioned."
-        if 'pain_points' in patient_data and len(patient_data['pain_points']) > 0:
-            pain_descriptions = [f"{pp.get('description', 'knee pain')} (severity: {pp.get('severity', 5)}/10)" 
-                               for pp in patient_data['pain_points']]
-            pain_points_text = "Pain points: " + "; ".join(pain_descriptions)
-        
-        prompt = f"""
-        I need to generate personalized knee rehabilitation exercises for a patient with the following profile:
-        
-        Name: {name}
-        Age: {age}
-        Exercise frequency: {frequency}
-        {pain_points_text}
-        
-        Please provide 3-5 evidence-based exercises appropriate for knee rehabilitation for this specific patient.
-        Consider standard physical therapy protocols and clinical practice guidelines.
-        
-        For each exercise, include:
-        1. A clear name
-        2. A concise description
-        3. Target joints (comma-separated list)
-        4. Step-by-step instructions (semicolon-separated list)
-        
-        DO NOT include video URLs or links. I will add them separately.
-        
-        Format your response as JSON according to this structure:
-        [
-          {{
-            "name": "Exercise Name",
-            "description": "Brief description of the exercise",
-            "target_joints": ["knee", "ankle"],
-            "instructions": [
-              "Step 1",
-              "Step 2",
-              "Step 3"
-            ]
-          }}
-        ]
-        
-        Respond ONLY with the JSON array and nothing else.
-        """
+        # Only the patient profile varies per call
+        prompt = build_patient_prompt(patient_data)
         
         logger.info("Calling OpenAI API to generate exercises")
         
-        # Call OpenAI API
-        response = requests.post(
+        # Call OpenAI API, streaming the response
+        response = http_session.post(
             "https://api.openai.com/v1/chat/completions",
             headers={
                 "Authorization": f"Bearer {api_key}",
                 "Content-Type": "application/json"
             },
             json={
-                "model": "gpt-4",
+                "model": model,
                 "messages": [
-                    {"role": "system", "content": "You are a senior physical therapist specializing in knee rehabilitation."},
+                    {"role": "system", "content": OPENAI_SYSTEM_PROMPT},
                     {"role": "user", "content": prompt}
                 ],
                 "temperature": 0.3,
-                "max_tokens": 2000
-            }
+                "max_tokens": LLM_MAX_TOKENS,
+                "stream": True,
+                "tools": [{
+                    "type": "function",
+                    "function": {
+                        "name": EXERCISES_TOOL_NAME,
+                        "description": EXERCISES_TOOL_DESCRIPTION,
+                        "parameters": EXERCISES_SCHEMA
+                    }
+                }],
+                "tool_choice": {"type": "function", "function": {"name": EXERCISES_TOOL_NAME}}
+            },
+            stream=True,
+            timeout=LLM_REQUEST_TIMEOUT
         )
         
         # Parse response
@@ -419,60 +684,353 @@ def generate_exercises_with_openai(patient_data, api_key):
             logger.error(f"OpenAI API error: {response.text}")
             raise Exception(f"OpenAI API error: {response.text}")
         
-        result = response.json()
-        content = result.get('choices', [{}])[0].get('message', {}).get('content', '[]')
+        # Yield each exercise as soon as its JSON object has been generated
+        text_stream = iter_llm_stream_text(response, 'openai')
+        exercise_count = 0
+        for exercise in iter_json_array_objects(text_stream):
+            exercise_count += 1
+            yield exercise
         
-        exercises = json.loads(content)
-        logger.info(f"OpenAI generated {len(exercises)} exercises")
+        # Drain the trailing stream events so the connection returns to the pool
+        for _ in text_stream:
+            pass
         
-        return exercises
+        logger.info(f"OpenAI generated {exercise_count} exercises")
     except Exception as e:
         logger.error(f"Error in generate_exercises_with_openai: {str(e)}", exc_info=True)
         raise Exception(f"Error in generate_exercises_with_openai: {str(e)}")
 
 
-def enhance_exercises_with_videos(exercises, google_api_key, google_cse_id):
+def build_patient_prompt(patient_data):
     """
-    Add real video URLs and thumbnails to exercises using Google Custom Search API
+    Build the per-patient user prompt for exercise generation
     """
-    enhanced_exercises = []
+    pain_points_text = "No specific pain points mentioned."
+    if 'pain_points' in patient_data and len(patient_data['pain_points']) > 0:
+        pain_descriptions = [f"{pp.get('description', 'knee pain')} (severity: {pp.get('severity', 5)}/10)" 
+                           for pp in patient_data['pain_points']]
+        pain_points_text = "Pain points: " + "; ".join(pain_descriptions)
     
-    for exercise in exercises:
-        # Create search query for exercise videos
-        search_query = f"{exercise['name']} physical therapy exercise"
-        logger.info(f"Searching for videos: '{search_query}'")
+    return PATIENT_PROMPT.format(
+        name=patient_data.get('name', 'the patient'),
+        age=patient_data.get('age', 'unknown age'),
+        frequency=patient_data.get('exercise_frequency', 'daily'),
+        pain_points_text=pain_points_text
+    )
+
+
+def iter_llm_stream_text(response, llm_provider):
+    """
+    Yield the text deltas from a streamed (server-sent events) Claude or OpenAI
+    response, including streamed tool call arguments. Raises if the response was
+    cut off by the token limit or the stream ended before the model finished.
+    """
+    # SSE payloads are UTF-8, but requests would default text/* to ISO-8859-1
+    response.encoding = 'utf-8'
+    complete = False
+    
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
         
-        video_data = search_youtube_video(search_query, google_api_key, google_cse_id)
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            complete = True
+            break
         
-        # Add video data to exercise
-        exercise_with_video = exercise.copy()
+        event = orjson.loads(data)
+        text = None
         
-        if video_data:
-            exercise_with_video['video_url'] = video_data.get('video_url', '')
-            exercise_with_video['video_thumbnail'] = video_data.get('thumbnail', '')
+        if llm_provider == 'openai':
+            choice = (event.get('choices') or [{}])[0]
+            if choice.get('finish_reason') == 'length':
+                raise Exception(f"OpenAI response was truncated at {LLM_MAX_TOKENS} tokens")
             
-            # Validate the found video
-            is_valid = validate_video_url(exercise_with_video['video_url'], exercise['name'])
-            if not is_valid:
-                # Try a more specific search if the first result isn't valid
-                logger.info(f"First video result for '{exercise['name']}' was invalid, trying alternative search...")
-                alt_search_query = f"{exercise['name']} knee rehabilitation exercise demonstration"
-                alt_video_data = search_youtube_video(alt_search_query, google_api_key, google_cse_id, num_results=5)
-                
-                if alt_video_data:
-                    exercise_with_video['video_url'] = alt_video_data.get('video_url', '')
-                    exercise_with_video['video_thumbnail'] = alt_video_data.get('thumbnail', '')
-                    logger.info(f"Alternative search found video: {exercise_with_video['video_url']}")
-                    validate_video_url(exercise_with_video['video_url'], exercise['name'])
-        else:
-            # Fallback if no video found
-            logger.warning(f"❌ No video found for '{exercise['name']}'")
-            exercise_with_video['video_url'] = ''
-            exercise_with_video['video_thumbnail'] = ''
+            delta = choice.get('delta', {})
+            tool_calls = delta.get('tool_calls')
+            text = tool_calls[0].get('function', {}).get('arguments') if tool_calls else delta.get('content')
+        elif event.get('type') == 'error':
+            raise Exception(f"Claude API error: {event.get('error')}")
+        elif event.get('type') == 'content_block_delta':
+            delta = event.get('delta', {})
+            text = delta.get('partial_json') if delta.get('type') == 'input_json_delta' else delta.get('text')
+        elif event.get('type') == 'message_delta':
+            if event.get('delta', {}).get('stop_reason') == 'max_tokens':
+                raise Exception(f"Claude response was truncated at {LLM_MAX_TOKENS} tokens")
+        elif event.get('type') == 'message_stop':
+            complete = True
+            break
+        
+        if text:
+            yield text
+    
+    if not complete:
+        raise Exception(f"{llm_provider} response stream ended before the model finished")
+
+
+def iter_json_array_objects(text_chunks):
+    """
+    Incrementally parse streamed text containing a JSON array of objects,
+    yielding each object as soon as its closing brace arrives. Any text before
+    the array (such as a ```json fence or the {"exercises": prefix of a tool
+    call) is skipped.
+    """
+    buffer = ''
+    pos = 0
+    depth = 0
+    object_start = None
+    array_started = False
+    in_string = False
+    escaped = False
+    
+    for chunk in text_chunks:
+        buffer += chunk
         
-        enhanced_exercises.append(exercise_with_video)
+        while pos < len(buffer):
+            char = buffer[pos]
+            
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                # Strings are tracked before the array too, so a "[" inside one
+                # is not mistaken for its start
+                in_string = True
+            elif not array_started:
+                array_started = char == '['
+            elif char == '{':
+                if depth == 0:
+                    object_start = pos
+                depth += 1
+            elif char == '}':
+                depth -= 1
+                if depth == 0:
+                    yield orjson.loads(buffer[object_start:pos + 1])
+                    # Drop the parsed text so the buffer stays small
+                    buffer = buffer[pos + 1:]
+                    pos = -1
+            elif char == ']' and depth == 0:
+                return
+            
+            pos += 1
+    
+    if not array_started:
+        raise ValueError("LLM response did not contain a JSON array of exercises")
+    
+    # The text ended inside the array, so the objects yielded so far are only part of it
+    raise ValueError("LLM response ended before the JSON array of exercises was complete")
+
+
+def collect_into(items, collected):
+    """
+    Yield items from an iterable while also appending them to a list
+    """
+    for item in items:
+        collected.append(item)
+        yield item
+
+
+def enhance_exercises_with_videos(exercises, google_api_key, google_cse_id):
+    """
+    Add real video URLs and thumbnails to exercises using Google Custom Search API.
+    Each exercise's search is started as soon as it arrives and the searches run
+    concurrently; results keep the order of the input.
+    """
+    with ThreadPoolExecutor(max_workers=VIDEO_SEARCH_WORKERS) as executor:
+        futures = [
+            executor.submit(enhance_exercise_with_video, exercise, google_api_key, google_cse_id)
+            for exercise in exercises
+        ]
+    
+    return [future.result() for future in futures]
+
+
+def enhance_exercise_with_video(exercise, google_api_key, google_cse_id):
+    """
+    Return a copy of the exercise with a video URL and thumbnail added
+    """
+    # Create search query for exercise videos
+    search_query = video_search_query(exercise['name'])
+    logger.info(f"Searching for videos: '{search_query}'")
+    
+    video_data = cached_search_youtube_video(search_query, google_api_key, google_cse_id)
+    
+    # Add video data to exercise
+    exercise_with_video = exercise.copy()
+    
+    if video_data:
+        exercise_with_video['video_url'] = video_data.get('video_url', '')
+        exercise_with_video['video_thumbnail'] = video_data.get('thumbnail', '')
+        
+        # With background validation the video is checked after the exercises are
+        # saved (see revalidate_videos), so only validate it here otherwise
+        if not BACKGROUND_VIDEO_VALIDATION and not validate_video_url(exercise_with_video['video_url'], exercise['name']):
+            # Try a more specific search if the first result isn't valid
+            logger.info(f"First video result for '{exercise['name']}' was invalid, trying alternative search...")
+            alt_video_data = search_alternative_video(exercise['name'], google_api_key, google_cse_id)
+            
+            if alt_video_data:
+                exercise_with_video['video_url'] = alt_video_data.get('video_url', '')
+                exercise_with_video['video_thumbnail'] = alt_video_data.get('thumbnail', '')
+                logger.info(f"Alternative search found video: {exercise_with_video['video_url']}")
+                validate_video_url(exercise_with_video['video_url'], exercise['name'])
+    else:
+        # Fallback if no video found
+        logger.warning(f"❌ No video found for '{exercise['name']}'")
+        exercise_with_video['video_url'] = ''
+        exercise_with_video['video_thumbnail'] = ''
+    
+    return exercise_with_video
+
+
+def video_search_query(exercise_name):
+    """
+    Return the primary video search query for an exercise
+    """
+    return f"{exercise_name} physical therapy exercise"
+
+
+def search_alternative_video(exercise_name, google_api_key, google_cse_id):
+    """
+    Search again with a more specific query, for when the first video found is unavailable
+    """
+    alt_search_query = f"{exercise_name} knee rehabilitation exercise demonstration"
+    return cached_search_youtube_video(alt_search_query, google_api_key, google_cse_id, num_results=5)
+
+
+def get_cached_video_search(cache_key, now):
+    """
+    Return an unexpired in-memory video search result, dropping it if it has expired
+    """
+    with video_search_cache_lock:
+        cached = video_search_cache.get(cache_key)
+        if not cached:
+            return None
+        if now - cached[1] > VIDEO_CACHE_TTL:
+            del video_search_cache[cache_key]
+            return None
+        video_search_cache.move_to_end(cache_key)
+        return cached[0]
+
+def remember_video_search(cache_key, video_data, cached_at):
+    """
+    Store a video search result in memory, evicting the least recently used
+    entries beyond VIDEO_CACHE_MAX_ENTRIES
+    """
+    with video_search_cache_lock:
+        video_search_cache[cache_key] = (video_data, cached_at)
+        video_search_cache.move_to_end(cache_key)
+        while len(video_search_cache) > VIDEO_CACHE_MAX_ENTRIES:
+            video_search_cache.popitem(last=False)
+
+def cached_search_youtube_video(query, google_api_key, google_cse_id, num_results=1):
+    """
+    Search for a YouTube video, reusing earlier results for the same normalized
+    query from this instance or from the video_cache collection. Only successful
+    searches are cached.
+    """
+    normalized_query = ' '.join(query.lower().split())
+    cache_key = video_cache_key(query, num_results)
+    now = datetime.now(timezone.utc)
+    
+    cached = get_cached_video_search(cache_key, now)
+    if cached:
+        return cached
+    
+    try:
+        cache_doc = get_db().collection('video_cache').document(cache_key).get()
+        if cache_doc.exists:
+            cached = cache_doc.to_dict()
+            if cached.get('created_at') and now - cached['created_at'] <= VIDEO_CACHE_TTL:
+                remember_video_search(cache_key, cached['video'], cached['created_at'])
+                return cached['video']
+    except Exception as e:
+        logger.warning(f"Error reading video cache: {str(e)}")
+    
+    video_data = search_youtube_video(query, google_api_key, google_cse_id, num_results=num_results)
+    
+    if video_data:
+        remember_video_search(cache_key, video_data, now)
+        try:
+            get_db().collection('video_cache').document(cache_key).set({
+                'query': normalized_query,
+                'video': video_data,
+                'created_at': now
+            })
+        except Exception as e:
+            logger.warning(f"Error writing video cache: {str(e)}")
+    
+    return video_data
+
+
+def video_cache_key(query, num_results=1):
+    """
+    Return the video cache key for a search query, ignoring case and whitespace
+    """
+    normalized_query = ' '.join(query.lower().split())
+    return hashlib.md5(f"{num_results}:{normalized_query}".encode()).hexdigest()
+
+
+def revalidate_videos(exercises, google_api_key, google_cse_id):
+    """
+    Validate the videos of saved exercises concurrently, replacing any that are unavailable
+    """
+    exercises_with_video = [exercise for exercise in exercises if exercise.get('video_url')]
+    if not exercises_with_video:
+        return
+    
+    with ThreadPoolExecutor(max_workers=min(len(exercises_with_video), VIDEO_SEARCH_WORKERS)) as executor:
+        for exercise in exercises_with_video:
+            executor.submit(revalidate_video, exercise, google_api_key, google_cse_id)
+
+
+def revalidate_video(exercise, google_api_key, google_cse_id):
+    """
+    Validate a saved exercise's video. If it is unavailable, drop it from the video
+    cache, search again and store the replacement on the exercise and its patient links
+    """
+    try:
+        if validate_video_url(exercise['video_url'], exercise['name']):
+            return
+        
+        cache_key = video_cache_key(video_search_query(exercise['name']))
+        with video_search_cache_lock:
+            video_search_cache.pop(cache_key, None)
+        get_db().collection('video_cache').document(cache_key).delete()
+        
+        # Only store the alternative if it is itself available
+        video_data = search_alternative_video(exercise['name'], google_api_key, google_cse_id) or {}
+        alt_url = video_data.get('video_url')
+        if not alt_url or alt_url == exercise['video_url'] or not validate_video_url(alt_url, exercise['name']):
+            video_data = {}
+        
+        update_exercise_video(exercise.get('id') or exercise_id_for_name(exercise['name']), {
+            'video_url': video_data.get('video_url', ''),
+            'video_thumbnail': video_data.get('thumbnail', '')
+        })
+        logger.info(f"Replaced unavailable video for '{exercise['name']}' with: {video_data.get('video_url') or 'none'}")
+    except Exception as e:
+        logger.error(f"Error revalidating video for '{exercise.get('name')}': {str(e)}", exc_info=True)
+
+
+def update_exercise_video(exercise_id, video_fields):
+    """
+    Write video fields to an exercise and to the copies embedded in its patient links
+    """
+    writes = [(get_db().collection('exercises').document(exercise_id), video_fields, True)]
     
-    return enhanced_exercises
+    # Legacy links without an embedded copy read the exercise document instead, so
+    # they are left alone rather than given a partial copy
+    links = get_db().collection('patient_exercises').where('exercise_id', '==', exercise_id).select(['exercise']).stream()
+    for link in links:
+        if link.to_dict().get('exercise'):
+            writes.append((link.reference, {'exercise': video_fields}, True))
+    
+    commit_writes(writes)
 
 
 def search_youtube_video(query, google_api_key, google_cse_id, num_results=1):
@@ -490,16 +1048,8 @@ def search_youtube_video(query, google_api_key, google_cse_id, num_results=1):
             'num': num_results  # Number of results to return
         }
         
-        logger.info(f"Calling Google Custom Search API with query: '{query} youtube'")
-        logger.info(f"API URL: {url}")
-        logger.info(f"API params: cx={google_cse_id}, num={num_results}")
-        
         # Make the API request
-        response = requests.get(url, params=params)
-        
-        # Log the response status and headers
-        logger.info(f"API response status: {response.status_code}")
-        logger.info(f"API response headers: {response.headers}")
+        response = http_session.get(url, params=params)
         
         # Check for errors
         if response.status_code != 200:
@@ -508,68 +1058,40 @@ def search_youtube_video(query, google_api_key, google_cse_id, num_results=1):
         
         # Process the response
         data = response.json()
+        items = data.get('items') or []
+        if not items and 'error' in data:
+            logger.error(f"API returned error: {data['error']}")
         
-        # Log the full response structure for debugging
-        logger.info(f"API response keys: {list(data.keys())}")
-        
-        if 'searchInformation' in data:
-            logger.info(f"Search info: {data['searchInformation']}")
-        
-        # Check if we got search results
-        if 'items' not in data or len(data['items']) == 0:
-            logger.warning("No search results found")
-            if 'error' in data:
-                logger.error(f"API returned error: {data['error']}")
-            return None
-        
-        # Log the number of results
-        logger.info(f"Found {len(data['items'])} search results")
+        # Per-result details are only built when debug logging is on
+        debug = logger.isEnabledFor(logging.DEBUG)
         
         # Get all video results
         all_videos = []
-        for idx, item in enumerate(data['items']):
-            # Log the structure of each result
-            logger.info(f"Result {idx+1} keys: {list(item.keys())}")
-            
+        for idx, item in enumerate(items):
             video_url = item.get('link', '')
-            logger.info(f"Result {idx+1} link: {video_url}")
-            
-            # Check if this is a YouTube link
-            is_youtube = 'youtube.com' in video_url or 'youtu.be' in video_url
-            logger.info(f"Result {idx+1} is YouTube: {is_youtube}")
             
             # Only process YouTube links
-            if not is_youtube:
-                logger.info(f"Skipping non-YouTube result: {video_url}")
+            if 'youtube.com' not in video_url and 'youtu.be' not in video_url:
+                if debug:
+                    logger.debug(f"Skipping non-YouTube result {idx+1}: {video_url}")
                 continue
                 
             # Get thumbnail image if available
             thumbnail = ''
-            if 'pagemap' in item:
-                logger.info(f"Result {idx+1} pagemap keys: {list(item['pagemap'].keys())}")
-                
-                if 'cse_image' in item['pagemap']:
-                    thumbnail = item['pagemap']['cse_image'][0].get('src', '')
-                    logger.info(f"Found thumbnail in cse_image: {thumbnail}")
-                elif 'videoobject' in item['pagemap']:
-                    thumbnail = item['pagemap']['videoobject'][0].get('thumbnailurl', '')
-                    logger.info(f"Found thumbnail in videoobject: {thumbnail}")
-            else:
-                logger.warning(f"Result {idx+1} has no pagemap")
+            pagemap = item.get('pagemap', {})
+            if 'cse_image' in pagemap:
+                thumbnail = pagemap['cse_image'][0].get('src', '')
+            elif 'videoobject' in pagemap:
+                thumbnail = pagemap['videoobject'][0].get('thumbnailurl', '')
             
             # If no thumbnail found, generate one from YouTube video ID
-            if not thumbnail and is_youtube:
-                video_id = None
-                if 'youtube.com/watch?v=' in video_url:
-                    video_id = video_url.split('youtube.com/watch?v=')[1].split('&')[0]
-                elif 'youtu.be/' in video_url:
-                    video_id = video_url.split('youtu.be/')[1].split('?')[0]
-                
+            if not thumbnail:
+                video_id = extract_youtube_video_id(video_url)
                 if video_id:
                     thumbnail = f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg"
-                    logger.info(f"Generated thumbnail from video ID: {thumbnail}")
             
-            logger.info(f"Final result {idx+1}: URL={video_url}, Thumbnail={thumbnail}")
+            if debug:
+                logger.debug(f"Result {idx+1}: URL={video_url}, Thumbnail={thumbnail}, pagemap keys={list(pagemap.keys())}")
             
             all_videos.append({
                 'title': item.get('title', 'Unknown'),
@@ -577,63 +1099,74 @@ def search_youtube_video(query, google_api_key, google_cse_id, num_results=1):
                 'thumbnail': thumbnail
             })
         
-        # If we have YouTube results
-        if all_videos:
-            logger.info(f"Found {len(all_videos)} YouTube videos")
-            # Return the first result
-            result = all_videos[0]
-            logger.info(f"Returning video: {result['video_url']}")
-            logger.info(f"With thumbnail: {result['thumbnail']}")
-            return result
-        else:
-            logger.warning("No YouTube videos found in search results")
-            return None
+        # Return the first YouTube result, if any
+        result = all_videos[0] if all_videos else None
+        chosen_url = result['video_url'] if result else None
+        had_thumbnail = bool(result and result['thumbnail'])
+        logger.info(f"Video search query={query!r} status={response.status_code} results={len(items)} youtube_results={len(all_videos)} chosen={chosen_url} had_thumbnail={had_thumbnail}")
+        return result
             
     except Exception as e:
         logger.error(f"Error searching for video: {str(e)}", exc_info=True)
         return None
 
 
+def extract_youtube_video_id(url):
+    """
+    Return the video ID from a youtube.com/watch?v= or youtu.be/ URL, or None
+    """
+    match = YOUTUBE_VIDEO_ID_RE.search(url)
+    return match.group(1) if match else None
+
+
 def get_video_thumbnail(video_url):
     """
     Extract or generate a thumbnail URL from a video URL if possible.
     This is a fallback for existing exercises that may not have thumbnails.
     """
     # For YouTube videos
-    if 'youtube.com' in video_url or 'youtu.be' in video_url:
-        # Extract YouTube video ID
-        video_id = None
-        if 'youtube.com/watch?v=' in video_url:
-            video_id = video_url.split('youtube.com/watch?v=')[1].split('&')[0]
-        elif 'youtu.be/' in video_url:
-            video_id = video_url.split('youtu.be/')[1].split('?')[0]
-        
-        if video_id:
-            thumbnail_url = f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg"
-            logger.info(f"Generated thumbnail URL: {thumbnail_url}")
-            return thumbnail_url
+    video_id = extract_youtube_video_id(video_url)
+    if video_id:
+        thumbnail_url = f"https://img.youtube.com/vi/{video_id}/hqdefault.jpg"
+        logger.info(f"Generated thumbnail URL: {thumbnail_url}")
+        return thumbnail_url
     
     # Default empty if we can't determine the thumbnail
     return ""
 
 
-def save_exercises(exercises, patient_id):
+def save_exercises(exercises, patient_id, after_commit=None):
     """
-    Save generated exercises to Firestore and link them to the patient
+    Save generated exercises to Firestore and link them to the patient.
+    after_commit, if given, is called with the saved exercises once the writes are committed.
     """
     saved_exercises = []
+    # (document reference, data, merge) writes, committed together at the end
+    writes = []
+    # (exercise ID, video fields) for existing exercises whose missing video is backfilled
+    video_backfills = []
+    # Stored timestamps are set by Firestore; the response uses this approximation
+    now = datetime.now()
     
+    # Collapse exercises the LLM repeated (names differing only in case or spacing
+    # map to the same ID), so each is written and linked once
+    unique_exercises = {}
     for exercise in exercises:
+        unique_exercises.setdefault(exercise_id_for_name(exercise['name']), exercise)
+    
+    # Generated exercises are keyed by name, so check which already exist in one batched read
+    exercise_refs = [get_db().collection('exercises').document(ex_id) for ex_id in unique_exercises]
+    existing_docs = {doc.id: doc for doc in get_db().get_all(exercise_refs) if doc.exists} if exercise_refs else {}
+    
+    for exercise_id, exercise in unique_exercises.items():
         # Log the video URL we're saving
         logger.info(f"Saving exercise '{exercise['name']}' with video URL: {exercise.get('video_url', 'None')}")
         
-        # Check if a similar exercise already exists
-        similar_exercises = db.collection('exercises').where('name', '==', exercise['name']).limit(1).get()
+        existing_doc = existing_docs.get(exercise_id)
         
-        if len(similar_exercises) > 0:
+        if existing_doc:
             # Use existing exercise
-            exercise_id = similar_exercises[0].id
-            exercise_data = similar_exercises[0].to_dict()
+            exercise_data = existing_doc.to_dict()
             
             # Update with video URL and thumbnail if they were missing
             if (not exercise_data.get('video_url') and exercise.get('video_url')) or \
@@ -645,12 +1178,10 @@ def save_exercises(exercises, patient_id):
                     updates['video_thumbnail'] = exercise['video_thumbnail']
                 
                 if updates:
-                    db.collection('exercises').document(exercise_id).update(updates)
+                    video_backfills.append((exercise_id, updates))
                     exercise_data.update(updates)
         else:
             # Create new exercise
-            exercise_id = str(uuid.uuid4())
-            
             # Format the instructions as an array if it's not already
             if isinstance(exercise['instructions'], str):
                 exercise['instructions'] = exercise['instructions'].split(';')
@@ -667,13 +1198,13 @@ def save_exercises(exercises, patient_id):
                 'instructions': exercise['instructions'],
                 'video_url': exercise.get('video_url', ''),
                 'video_thumbnail': exercise.get('video_thumbnail', ''),
-                'created_at': datetime.now(),
+                'created_at': now,
                 'is_template': False,
                 'source': 'llm-generated'
             }
             
-            # Save to Firestore
-            db.collection('exercises').document(exercise_id).set(exercise_data)
+            # Queue the new exercise for saving
+            writes.append((get_db().collection('exercises').document(exercise_id), {**exercise_data, 'created_at': firestore.SERVER_TIMESTAMP}, False))
         
         # Create patient-exercise link
         patient_exercise_id = str(uuid.uuid4())
@@ -681,7 +1212,7 @@ def save_exercises(exercises, patient_id):
             'id': patient_exercise_id,
             'patient_id': patient_id,
             'exercise_id': exercise_id,
-            'recommended_at': datetime.now(),
+            'recommended_at': firestore.SERVER_TIMESTAMP,
             'pt_modified': False,
             'pt_id': None,
             'frequency': 'daily',  # Default, can be modified by PT
@@ -689,7 +1220,98 @@ def save_exercises(exercises, patient_id):
             'repetitions': 10      # Default, can be modified by PT
         }
         
-        db.collection('patient_exercises').document(patient_exercise_id).set(patient_exercise)
+        # Embed a copy of the exercise so the patient's assignments can be read back
+        # without a second lookup in the exercises collection
+        writes.append((get_db().collection('patient_exercises').document(patient_exercise_id), {**patient_exercise, 'exercise': exercise_data}, False))
         saved_exercises.append(exercise_data)
     
-    return saved_exercises
\ No newline at end of file
+    def commit_exercises():
+        # Save everything to Firestore in as few round-trips as possible
+        commit_writes(writes)
+        
+        # Patient links embed a copy of the exercise, so backfilled videos are written
+        # to the existing links as well as the exercise
+        for exercise_id, video_fields in video_backfills:
+            update_exercise_video(exercise_id, video_fields)
+        
+        if after_commit is not None:
+            after_commit(saved_exercises)
+    
+    run_write(commit_exercises)
+    
+    return saved_exercises
+
+
+def normalize_exercise_name(name):
+    """
+    Lowercase an exercise name and collapse its whitespace. Shared with
+    add_custom_exercise, which keys its name index the same way
+    """
+    return ' '.join((name or '').lower().split())
+
+
+def exercise_id_for_name(name):
+    """
+    Derive a deterministic exercise ID from a normalized exercise name, so the
+    same generated exercise always maps to the same document
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, normalize_exercise_name(name)))
+
+
+def commit_writes(writes):
+    """
+    Commit (document reference, data, merge) writes. Up to FIRESTORE_BATCH_LIMIT
+    writes go out as one atomic WriteBatch; larger sets are split into batches
+    that are committed concurrently. All writes to the same document stay in the
+    same batch so they are applied in order.
+    """
+    if len(writes) <= FIRESTORE_BATCH_LIMIT:
+        batches = [writes]
+    else:
+        writes_by_document = {}
+        for write in writes:
+            writes_by_document.setdefault(write[0].path, []).append(write)
+        
+        batches = [[]]
+        for document_writes in writes_by_document.values():
+            if len(batches[-1]) + len(document_writes) > FIRESTORE_BATCH_LIMIT:
+                batches.append([])
+            batches[-1].extend(document_writes)
+    
+    def commit_batch(batch_writes):
+        batch = get_db().batch()
+        for doc_ref, data, merge in batch_writes:
+            batch.set(doc_ref, data, merge=merge)
+        batch.commit()
+    
+    if len(batches) == 1:
+        commit_batch(batches[0])
+        return
+    
+    with ThreadPoolExecutor(max_workers=min(len(batches), FIRESTORE_COMMIT_WORKERS)) as executor:
+        # list() surfaces any commit error
+        list(executor.map(commit_batch, batches))
+
+
+def run_write(write_fn, *args):
+    """
+    Run a Firestore write, in the background when BACKGROUND_WRITES is enabled
+    """
+    if not BACKGROUND_WRITES:
+        write_fn(*args)
+        return
+    
+    run_in_background(write_fn, *args)
+
+
+def run_in_background(fn, *args):
+    """
+    Run fn on a daemon thread, logging any error it raises
+    """
+    def run():
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error(f"Error in background task {fn.__name__}: {str(e)}", exc_info=True)
+    
+    threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,60 @@
+import pytest
+
+from main import iter_json_array_objects
+
+
+def chunked(text, size):
+    """
+    Split text into chunks of the given size, as a streamed response would arrive
+    """
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_yields_each_object_in_the_array():
+    text = '[{"name": "Squat"}, {"name": "Lunge"}]'
+    assert list(iter_json_array_objects([text])) == [{'name': 'Squat'}, {'name': 'Lunge'}]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7])
+def test_objects_split_across_chunks(size):
+    text = '```json\n[{"name": "Squat", "target_joints": ["knee", "hip"]}, {"name": "Lunge"}]\n```'
+    assert list(iter_json_array_objects(chunked(text, size))) == [
+        {'name': 'Squat', 'target_joints': ['knee', 'hip']},
+        {'name': 'Lunge'}
+    ]
+
+
+def test_skips_tool_call_prefix():
+    text = '{"exercises": [{"name": "Squat"}]}'
+    assert list(iter_json_array_objects(chunked(text, 4))) == [{'name': 'Squat'}]
+
+
+def test_bracket_in_string_before_array():
+    text = '{"note": "use [brackets] and {braces}", "exercises": [{"name": "Squat"}]}'
+    assert list(iter_json_array_objects(chunked(text, 5))) == [{'name': 'Squat'}]
+
+
+def test_escaped_quotes_and_brackets_in_strings():
+    text = r'[{"name": "Wall \"sit\" [hold]", "description": "Back \\ wall }"}]'
+    assert list(iter_json_array_objects(chunked(text, 3))) == [
+        {'name': 'Wall "sit" [hold]', 'description': 'Back \\ wall }'}
+    ]
+
+
+def test_nested_objects():
+    text = '[{"name": "Squat", "dosage": {"sets": 3, "reps": {"min": 8, "max": 12}}}]'
+    assert list(iter_json_array_objects(chunked(text, 4))) == [
+        {'name': 'Squat', 'dosage': {'sets': 3, 'reps': {'min': 8, 'max': 12}}}
+    ]
+
+
+def test_truncated_array_raises_after_complete_objects():
+    objects = iter_json_array_objects(chunked('[{"name": "Squat"}, {"name": "Lu', 4))
+    assert next(objects) == {'name': 'Squat'}
+    with pytest.raises(ValueError, match='ended before'):
+        next(objects)
+
+
+def test_missing_array_raises():
+    with pytest.raises(ValueError, match='did not contain'):
+        list(iter_json_array_objects(['{"note": "[not an array]"}']))
@@ -1,14 +1,55 @@
 import functions_framework
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore, firestore_async
 import openai
 import json
+import re
+import asyncio
+import threading
+import os
 from datetime import datetime
 
 # Initialize Firebase Admin
 cred = credentials.Certificate('service-account.json')
 firebase_admin.initialize_app(cred)
-db = firestore.client()
+db = firestore_async.client()
+
+# Event loop shared by all requests. It runs on a background thread so the async
+# Firestore and OpenAI clients keep their connections between invocations
+event_loop = asyncio.new_event_loop()
+threading.Thread(target=event_loop.run_forever, daemon=True).start()
+
+# Let the report write finish after the response is returned. Only enable where
+# CPU stays allocated after a response (Cloud Functions gen2 or Cloud Run with
+# CPU always allocated); otherwise the write may never finish
+BACKGROUND_WRITES = os.environ.get('BACKGROUND_WRITES', 'false').lower() == 'true'
+# Strong references to in-flight background writes so they are not garbage collected
+background_tasks = set()
+
+# Numbers followed by "set(s)", "rep(s)" or "minute(s)", matched in a single pass.
+# METRIC_KEYS maps the first letter of the unit to its metric
+METRIC_PATTERN = re.compile(r'(\d+)\s*(sets?|reps?|minutes?)', re.IGNORECASE)
+METRIC_KEYS = {'s': 'sets_completed', 'r': 'reps_completed', 'm': 'duration_minutes'}
+
+# Report fields sent to the model as history; the long narrative fields are left out
+HISTORY_FIELDS = ['exercise_name', 'sets_completed', 'reps_completed', 'duration_minutes', 'completed', 'day_streak', 'timestamp']
+
+# Upper bound in seconds on the report completion request
+REPORT_REQUEST_TIMEOUT = 60
+
+# Initialize OpenAI client lazily (reads OPENAI_API_KEY from the environment)
+openai_client = None
+
+def get_openai_client():
+    """Return the shared async OpenAI client, creating it on first use."""
+    global openai_client
+    if openai_client is None:
+        openai_client = openai.AsyncOpenAI()
+    return openai_client
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, event_loop).result()
 
 @functions_framework.http
 def generate_pt_report(request):
@@ -33,27 +74,33 @@ def generate_pt_report(request):
         if not patient_id or not exercise_id:
             return (json.dumps({'error': 'Missing required parameters'}), 400, headers)
         
-        # Get exercise details from Firestore
-        exercise_ref = db.collection('exercises').document(exercise_id)
-        exercise_doc = exercise_ref.get()
-        
-        if not exercise_doc.exists:
-            return (json.dumps({'error': 'Exercise not found'}), 404, headers)
-            
-        exercise_data = exercise_doc.to_dict()
-        
-        # Get patient's exercise history
-        patient_history = db.collection('exercise_reports').where('patient_id', '==', patient_id).order_by('timestamp', direction=firestore.Query.DESCENDING).limit(5).get()
-        recent_exercises = [doc.to_dict() for doc in patient_history]
+        return run_async(generate_pt_report_async(patient_id, exercise_id, conversation_history, headers))
         
-        # Extract exercise metrics from conversation
-        metrics = extract_exercise_metrics(conversation_history)
-        
-        # Format conversation history for GPT
-        formatted_history = format_conversation_history(conversation_history)
+    except Exception as e:
+        print(f"Error generating report: {str(e)}")
+        return (json.dumps({'error': str(e)}), 500, headers)
+
+async def generate_pt_report_async(patient_id, exercise_id, conversation_history, headers):
+    """Generate the report with the async OpenAI and Firestore clients."""
+    # Extract exercise metrics from conversation
+    metrics = extract_exercise_metrics(conversation_history)
+    
+    # Get exercise details and the patient's exercise history concurrently
+    exercise_ref = db.collection('exercises').document(exercise_id)
+    history_query = db.collection('exercise_reports').where('patient_id', '==', patient_id).order_by('timestamp', direction=firestore.Query.DESCENDING).select(HISTORY_FIELDS).limit(5)
+    exercise_doc, patient_history = await asyncio.gather(exercise_ref.get(), history_query.get())
+    
+    if not exercise_doc.exists:
+        return (json.dumps({'error': 'Exercise not found'}), 404, headers)
         
-        # Create GPT prompt
-        prompt = f"""Based on the following exercise session conversation and patient history, generate a comprehensive physical therapy report:
+    exercise_data = exercise_doc.to_dict()
+    recent_exercises = [doc.to_dict() for doc in patient_history]
+    
+    # Format conversation history for GPT
+    formatted_history = format_conversation_history(conversation_history)
+    
+    # Create GPT prompt
+    prompt = f"""Based on the following exercise session conversation and patient history, generate a comprehensive physical therapy report:
 
 Exercise: {exercise_data.get('name', 'Unknown')}
 Date: {datetime.now().strftime('%Y-%m-%d')}
@@ -64,7 +111,7 @@ Reps Completed: {metrics['reps_completed']}
 Exercise Duration: {metrics['duration_minutes']} minutes
 
 Recent Exercise History:
-{json.dumps(recent_exercises, indent=2)}
+{json.dumps(recent_exercises, default=str)}
 
 Conversation History:
 {formatted_history}
@@ -93,51 +140,89 @@ Format the response as JSON with these exact keys:
     "motivational_message": "string"
 }}"""
 
-        # Call OpenAI API
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": """You are a professional physical therapist assistant. 
-                Generate detailed, accurate reports based on exercise session conversations.
-                Focus on specific, actionable insights and maintain a supportive, encouraging tone.
-                Consider the patient's history and progress when providing feedback.
-                Be precise about exercise metrics and ensure they match what was discussed in the conversation."""},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=1000
-        )
-        
-        # Parse GPT response
-        report_data = json.loads(response.choices[0].message.content)
-        
-        # Ensure the metrics match what we extracted
-        report_data['sets_completed'] = metrics['sets_completed']
-        report_data['reps_completed'] = metrics['reps_completed']
-        
-        # Store report in Firestore
-        report_ref = db.collection('exercise_reports').document()
-        report_data.update({
-            'patient_id': patient_id,
-            'exercise_id': exercise_id,
-            'timestamp': firestore.SERVER_TIMESTAMP,
-            'exercise_name': exercise_data.get('name', 'Unknown'),
-            'exercise_description': exercise_data.get('description', ''),
-            'target_joints': exercise_data.get('target_joints', []),
-            'instructions': exercise_data.get('instructions', []),
-            'duration_minutes': metrics['duration_minutes']
-        })
-        report_ref.set(report_data)
-        
-        return (json.dumps({
-            'status': 'success',
-            'report_id': report_ref.id,
-            'report': report_data
-        }), 200, headers)
-        
-    except Exception as e:
-        print(f"Error generating report: {str(e)}")
-        return (json.dumps({'error': str(e)}), 500, headers)
+    # Call OpenAI API, streaming so the report is used as soon as its JSON is complete
+    stream = await get_openai_client().chat.completions.create(
+        model="gpt-4",
+        messages=[
+            {"role": "system", "content": """You are a professional physical therapist assistant. 
+            Generate detailed, accurate reports based on exercise session conversations.
+            Focus on specific, actionable insights and maintain a supportive, encouraging tone.
+            Consider the patient's history and progress when providing feedback.
+            Be precise about exercise metrics and ensure they match what was discussed in the conversation."""},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.7,
+        max_tokens=1000,
+        stream=True,
+        timeout=REPORT_REQUEST_TIMEOUT
+    )
+    
+    # Parse GPT response
+    report_data = await read_report_stream(stream)
+    
+    return await store_report(report_data, patient_id, exercise_id, exercise_data, metrics, headers)
+
+async def read_report_stream(stream):
+    """Read a streamed completion and return the report once its JSON object is complete."""
+    decoder = json.JSONDecoder()
+    content = ''
+    try:
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            content += delta
+            
+            # The report is a single object, so it can only be complete once a closing brace arrives
+            if '}' in delta:
+                try:
+                    return decoder.raw_decode(content.lstrip())[0]
+                except json.JSONDecodeError:
+                    pass
+    finally:
+        # Release the connection without waiting for any trailing tokens
+        await stream.response.aclose()
+    
+    return json.loads(content)
+
+async def store_report(report_data, patient_id, exercise_id, exercise_data, metrics, headers):
+    """Save the report to Firestore and build the response."""
+    # Ensure the metrics match what we extracted
+    report_data['sets_completed'] = metrics['sets_completed']
+    report_data['reps_completed'] = metrics['reps_completed']
+    
+    # Store report in Firestore while the response is serialized. The report ID is
+    # generated client-side, so the response does not depend on the write
+    report_ref = db.collection('exercise_reports').document()
+    report_data.update({
+        'patient_id': patient_id,
+        'exercise_id': exercise_id,
+        'exercise_name': exercise_data.get('name', 'Unknown'),
+        'exercise_description': exercise_data.get('description', ''),
+        'target_joints': exercise_data.get('target_joints', []),
+        'instructions': exercise_data.get('instructions', []),
+        'duration_minutes': metrics['duration_minutes']
+    })
+    write_task = asyncio.create_task(report_ref.set({**report_data, 'timestamp': firestore.SERVER_TIMESTAMP}))
+    
+    body = json.dumps({
+        'status': 'success',
+        'report_id': report_ref.id,
+        'report': report_data
+    })
+    
+    if BACKGROUND_WRITES:
+        background_tasks.add(write_task)
+        write_task.add_done_callback(finish_background_write)
+    else:
+        await write_task
+    return (body, 200, headers)
+
+def finish_background_write(task):
+    """Release a finished background write and log it if it failed."""
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Error storing report: {str(task.exception())}")
 
 def extract_exercise_metrics(conversation_history):
     """Extract exercise metrics from conversation history."""
@@ -147,29 +232,14 @@ def extract_exercise_metrics(conversation_history):
         'duration_minutes': 0
     }
     
-    # Initialize variables to track the latest metrics mentioned
     for message in conversation_history:
-        content = message.get('content', '').lower()
-        
-        # Look for sets completed
-        if 'set' in content or 'sets' in content:
-            # Try to find numbers followed by "set" or "sets"
-            import re
-            set_matches = re.findall(r'(\d+)\s*sets?', content)
-            if set_matches:
-                metrics['sets_completed'] = max(metrics['sets_completed'], int(set_matches[-1]))
-        
-        # Look for reps completed
-        if 'rep' in content or 'reps' in content:
-            rep_matches = re.findall(r'(\d+)\s*reps?', content)
-            if rep_matches:
-                metrics['reps_completed'] = max(metrics['reps_completed'], int(rep_matches[-1]))
+        # Keep the last number mentioned for each metric in this message
+        latest = {}
+        for match in METRIC_PATTERN.finditer(message.get('content', '')):
+            latest[METRIC_KEYS[match.group(2)[0].lower()]] = int(match.group(1))
         
-        # Look for duration
-        if 'minute' in content or 'minutes' in content:
-            duration_matches = re.findall(r'(\d+)\s*minutes?', content)
-            if duration_matches:
-                metrics['duration_minutes'] = max(metrics['duration_minutes'], int(duration_matches[-1]))
+        for key, value in latest.items():
+            metrics[key] = max(metrics[key], value)
     
     return metrics
 
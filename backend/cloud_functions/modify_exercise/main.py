@@ -1,15 +1,35 @@
 import functions_framework
 import json
 import uuid
+import os
+import re
 from google.cloud import firestore, storage
-from datetime import datetime
+from datetime import datetime, timedelta
 import base64
+import google.auth
+from google.auth.transport import requests as google_auth_requests
 
 # Initialize Firestore DB
 db = firestore.Client()
 # Initialize Cloud Storage
 storage_client = storage.Client()
 bucket_name = "duoligo-pt-app-videos"  # This bucket should be created in GCP
+# Set VIDEO_BUCKET_UNIFORM_ACCESS=true once the bucket has been migrated to uniform
+# bucket-level access with an allUsers:objectViewer binding. Until then each uploaded
+# video is made public with an object ACL (make_public fails under uniform access)
+VIDEO_BUCKET_UNIFORM_ACCESS = os.environ.get('VIDEO_BUCKET_UNIFORM_ACCESS', 'false').lower() == 'true'
+
+# How long a signed video upload URL stays valid
+UPLOAD_URL_EXPIRATION = timedelta(minutes=15)
+# Largest video accepted through a signed upload URL, enforced by Cloud Storage
+MAX_VIDEO_UPLOAD_BYTES = 200 * 1024 * 1024
+# Video content types accepted for custom exercise videos
+ALLOWED_VIDEO_CONTENT_TYPES = {'video/mp4', 'video/quicktime', 'video/webm', 'video/x-m4v'}
+
+# Default credentials, used to sign upload URLs through the IAM API since the
+# function's service account has no private key; created on first use. Requires
+# roles/iam.serviceAccountTokenCreator (see get_video_upload_url)
+signing_credentials = None
 
 # Custom JSON encoder to handle datetime objects
 class DateTimeEncoder(json.JSONEncoder):
@@ -37,12 +57,17 @@ def modify_exercise(request):
             "repetitions": 10,
             "notes": "Start with lower intensity"
         },
+        "custom_video": {
+            "blob_name": "exercise-videos/..."  // returned by get_video_upload_url
+        }
+    }
+    
+    Older clients may send the video inline instead:
         "custom_video": {
             "base64_data": "base64-encoded-video-data",
             "content_type": "video/mp4",
             "filename": "exercise-video.mp4"
         }
-    }
     """
     # Enable CORS
     if request.method == 'OPTIONS':
@@ -90,7 +115,7 @@ def modify_exercise(request):
         update_data = {
             'pt_modified': True,
             'pt_id': pt_id,
-            'updated_at': datetime.now()
+            'updated_at': firestore.SERVER_TIMESTAMP
         }
         
         if 'frequency' in modifications:
@@ -105,30 +130,41 @@ def modify_exercise(request):
         if 'notes' in modifications:
             update_data['notes'] = modifications['notes']
         
-        # Update the patient exercise document
-        patient_exercise_ref.update(update_data)
+        # Writes are committed together in one batch once any video upload has succeeded
+        batch = db.batch()
+        updated_exercise = exercise_data
         
         # If a custom video was provided, upload it to Cloud Storage
         video_url = None
-        if custom_video and 'base64_data' in custom_video:
+        if custom_video and ('blob_name' in custom_video or 'base64_data' in custom_video):
             try:
-                # Get video data
-                video_data = base64.b64decode(custom_video['base64_data'])
-                content_type = custom_video.get('content_type', 'video/mp4')
-                filename = custom_video.get('filename', f'{exercise_id}-{patient_id}.mp4')
-                
-                # Create a unique filename to avoid collisions
-                blob_name = f"exercise-videos/{patient_id}/{exercise_id}/{uuid.uuid4()}-{filename}"
-                
                 # Get the bucket
                 bucket = storage_client.bucket(bucket_name)
-                # Create a new blob
-                blob = bucket.blob(blob_name)
-                # Upload the video
-                blob.upload_from_string(video_data, content_type=content_type)
                 
-                # Make the blob publicly readable
-                blob.make_public()
+                if 'blob_name' in custom_video:
+                    # The client already uploaded the video with a signed URL. Only accept
+                    # uploads made for this assignment's patient and exercise, taken from
+                    # the stored link rather than the request
+                    blob = bucket.blob(custom_video['blob_name'])
+                    upload_prefix = f"exercise-videos/{patient_exercise_data.get('patient_id')}/{exercise_id}/"
+                    if not blob.name.startswith(upload_prefix) or not blob.exists():
+                        return (json.dumps({'error': 'Uploaded video not found'}, cls=DateTimeEncoder), 404, headers)
+                else:
+                    # Get video data
+                    video_data = base64.b64decode(custom_video['base64_data'])
+                    content_type = custom_video.get('content_type', 'video/mp4')
+                    filename = custom_video.get('filename', f'{exercise_id}-{patient_id}.mp4')
+                    if content_type not in ALLOWED_VIDEO_CONTENT_TYPES:
+                        return (json.dumps({'error': f'Unsupported video content type: {content_type}'}, cls=DateTimeEncoder), 400, headers)
+                    
+                    # Create a new blob with a unique filename to avoid collisions
+                    blob = bucket.blob(video_blob_name(patient_id, exercise_id, filename))
+                    # Upload the video
+                    blob.upload_from_string(video_data, content_type=content_type)
+                
+                # Make the blob publicly readable, unless the bucket already grants public read
+                if not VIDEO_BUCKET_UNIFORM_ACCESS:
+                    blob.make_public()
                 
                 # Get the public URL
                 video_url = blob.public_url
@@ -149,20 +185,24 @@ def modify_exercise(request):
                 })
                 
                 # Save the new exercise
-                db.collection('exercises').document(new_exercise_id).set(new_exercise_data)
+                batch.set(db.collection('exercises').document(new_exercise_id), new_exercise_data)
                 
-                # Update the patient-exercise link to point to the new exercise
-                patient_exercise_ref.update({
-                    'exercise_id': new_exercise_id
-                })
+                # Point the patient-exercise link to the new exercise, keeping its
+                # embedded copy of the exercise in sync
+                update_data['exercise_id'] = new_exercise_id
+                update_data['exercise'] = new_exercise_data
+                updated_exercise = new_exercise_data
                 
             except Exception as e:
                 return (json.dumps({'error': f'Error uploading video: {str(e)}'}, cls=DateTimeEncoder), 500, headers)
         
-        # Get the updated exercise data to return
-        updated_patient_exercise = patient_exercise_ref.get().to_dict()
-        updated_exercise_ref = db.collection('exercises').document(updated_patient_exercise['exercise_id'])
-        updated_exercise = updated_exercise_ref.get().to_dict()
+        # Update the patient exercise document
+        batch.update(patient_exercise_ref, update_data)
+        batch.commit()
+        
+        # Build the updated link in memory so it need not be read back. The
+        # response uses the local time in place of the server timestamp
+        updated_patient_exercise = {**patient_exercise_data, **update_data, 'updated_at': datetime.now()}
         
         # Return success response
         response = {
@@ -175,4 +215,113 @@ def modify_exercise(request):
         return (json.dumps(response, cls=DateTimeEncoder), 200, headers)
         
     except Exception as e:
-        return (json.dumps({'error': f'Error modifying exercise: {str(e)}'}, cls=DateTimeEncoder), 500, headers)
\ No newline at end of file
+        return (json.dumps({'error': f'Error modifying exercise: {str(e)}'}, cls=DateTimeEncoder), 500, headers)
+
+
+@functions_framework.http
+def get_video_upload_url(request):
+    """
+    Cloud Function that returns a signed URL for uploading a custom exercise video
+    straight to Cloud Storage. The client PUTs the video to upload_url with the
+    returned upload_headers, then passes blob_name to modify_exercise as custom_video.
+    URLs are only issued for exercises assigned to the patient, and Cloud Storage
+    rejects uploads larger than MAX_VIDEO_UPLOAD_BYTES.
+    
+    Deployment: URLs are signed through the IAM signBlob API, so the function's runtime
+    service account needs roles/iam.serviceAccountTokenCreator on itself, e.g.
+    gcloud iam service-accounts add-iam-policy-binding SA_EMAIL
+        --member=serviceAccount:SA_EMAIL --role=roles/iam.serviceAccountTokenCreator
+    
+    Request format:
+    {
+        "patient_id": "uuid-of-patient",
+        "exercise_id": "uuid-of-exercise",
+        "content_type": "video/mp4",
+        "filename": "exercise-video.mp4"
+    }
+    """
+    # Enable CORS
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'POST',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+    
+    headers = {'Access-Control-Allow-Origin': '*'}
+    
+    try:
+        request_json = request.get_json(silent=True)
+        
+        if not request_json or 'patient_id' not in request_json or 'exercise_id' not in request_json:
+            return (json.dumps({'error': 'Invalid request - missing patient_id or exercise_id'}), 400, headers)
+        
+        patient_id = request_json['patient_id']
+        exercise_id = request_json['exercise_id']
+        content_type = request_json.get('content_type', 'video/mp4')
+        filename = request_json.get('filename', f'{exercise_id}-{patient_id}.mp4')
+        
+        if not isinstance(patient_id, str) or not isinstance(exercise_id, str):
+            return (json.dumps({'error': 'Invalid request - patient_id and exercise_id must be strings'}), 400, headers)
+        
+        if content_type not in ALLOWED_VIDEO_CONTENT_TYPES:
+            return (json.dumps({'error': f'Unsupported video content type: {content_type}'}), 400, headers)
+        
+        # Only issue upload URLs for exercises assigned to this patient
+        assignments = db.collection('patient_exercises').where('patient_id', '==', patient_id).where('exercise_id', '==', exercise_id).limit(1).get()
+        if len(assignments) == 0:
+            return (json.dumps({'error': 'Patient exercise not found'}), 404, headers)
+        
+        blob = storage_client.bucket(bucket_name).blob(video_blob_name(patient_id, exercise_id, filename))
+        
+        # The client must send these headers with the upload; Cloud Storage enforces the size range
+        upload_headers = {
+            'Content-Type': content_type,
+            'x-goog-content-length-range': f'0,{MAX_VIDEO_UPLOAD_BYTES}'
+        }
+        
+        # Sign with the function's service account through the IAM API
+        credentials = get_signing_credentials()
+        upload_url = blob.generate_signed_url(
+            version='v4',
+            expiration=UPLOAD_URL_EXPIRATION,
+            method='PUT',
+            content_type=content_type,
+            headers={'x-goog-content-length-range': upload_headers['x-goog-content-length-range']},
+            service_account_email=credentials.service_account_email,
+            access_token=credentials.token
+        )
+        
+        return (json.dumps({
+            'status': 'success',
+            'upload_url': upload_url,
+            'upload_headers': upload_headers,
+            'blob_name': blob.name,
+            'content_type': content_type
+        }), 200, headers)
+        
+    except Exception as e:
+        return (json.dumps({'error': f'Error creating upload URL: {str(e)}'}), 500, headers)
+
+
+def video_blob_name(patient_id, exercise_id, filename):
+    """
+    Return a unique Cloud Storage object name for a custom exercise video. The
+    client-supplied filename is reduced to a short, path-free name
+    """
+    safe_filename = re.sub(r'[^A-Za-z0-9._-]', '_', str(filename).replace('\\', '/').split('/')[-1])[:100].lstrip('.')
+    return f"exercise-videos/{patient_id}/{exercise_id}/{uuid.uuid4()}-{safe_filename or 'video'}"
+
+
+def get_signing_credentials():
+    """
+    Return the default credentials with a current access token for URL signing
+    """
+    global signing_credentials
+    if signing_credentials is None:
+        signing_credentials, _ = google.auth.default()
+    if not signing_credentials.valid:
+        signing_credentials.refresh(google_auth_requests.Request())
+    return signing_credentials
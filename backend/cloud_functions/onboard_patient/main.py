@@ -39,6 +39,12 @@ VALID_FREQUENCIES = [
     "Every other day"
 ]
 
+# Lowercased lookup set so frequency validation is a single hash check
+VALID_FREQUENCY_SET = frozenset(f.lower() for f in VALID_FREQUENCIES)
+
+# Notification time must be HH:MM in 24-hour format
+NOTIFICATION_TIME_RE = re.compile(r'^([01]\d|2[0-3]):([0-5]\d)$')
+
 @functions_framework.http
 def onboard_patient(request):
     """
@@ -153,7 +159,7 @@ def process_structured_onboarding(request_data, headers):
         # Convert to lowercase for case-insensitive validation
         frequency_lower = frequency.lower()
         
-        if frequency_lower not in VALID_FREQUENCIES:
+        if frequency_lower not in VALID_FREQUENCY_SET:
             # Log exact state for debugging
             logger.error(f"Invalid frequency: '{frequency_lower}' not in {VALID_FREQUENCIES}")
             valid_options = ", ".join(VALID_FREQUENCIES)
@@ -161,7 +167,7 @@ def process_structured_onboarding(request_data, headers):
             return (json.dumps({'error': error_msg}, cls=DateTimeEncoder), 400, headers)
         
         # Validate notification_time format (HH:MM, 24hr)
-        if not re.match(r'^([01]\d|2[0-3]):([0-5]\d)$', notification_time):
+        if not NOTIFICATION_TIME_RE.match(notification_time):
             error_msg = f"Invalid notification time format. Must be HH:MM in 24-hour format, got {notification_time}"
             logger.error(error_msg)
             return (json.dumps({'error': error_msg}, cls=DateTimeEncoder), 400, headers)
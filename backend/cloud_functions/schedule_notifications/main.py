@@ -4,7 +4,8 @@ import uuid
 import firebase_admin
 from firebase_admin import credentials, messaging, firestore
 from datetime import datetime, timedelta
-from google.cloud import scheduler_v1
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import AlreadyExists, NotFound
 import os
 
 # Initialize Firebase Admin SDK (for FCM)
@@ -19,12 +20,18 @@ except ValueError:
 # Initialize Firestore DB
 db = firestore.Client()
 
-# Initialize Cloud Scheduler client
-scheduler_client = scheduler_v1.CloudSchedulerClient()
+# Cloud Scheduler client, created on first use since send_notification never needs it
+scheduler_client = None
 project_id = os.environ.get('PROJECT_ID', 'pep-pro')
 location_id = 'us-central1'
 parent = f"projects/{project_id}/locations/{location_id}"
 
+# Day names to cron day-of-week numbers (0=Sunday, 1=Monday, etc.)
+DAY_MAP = {
+    'sunday': 0, 'monday': 1, 'tuesday': 2, 'wednesday': 3,
+    'thursday': 4, 'friday': 5, 'saturday': 6
+}
+
 @functions_framework.http
 def schedule_notifications(request):
     """
@@ -70,13 +77,13 @@ def schedule_notifications(request):
         # Save FCM token to patient record
         db.collection('patients').document(patient_id).update({
             'fcm_token': fcm_token,
-            'updated_at': datetime.now()
+            'updated_at': firestore.SERVER_TIMESTAMP
         })
         
-        # Get patient exercises
-        patient_exercises = db.collection('patient_exercises').where('patient_id', '==', patient_id).get()
+        # Check the patient has exercises; a count aggregation avoids downloading them
+        exercise_count = db.collection('patient_exercises').where('patient_id', '==', patient_id).count().get()[0][0].value
         
-        if len(patient_exercises) == 0:
+        if exercise_count == 0:
             return (json.dumps({'error': 'No exercises found for patient'}), 404, headers)
         
         # Create a Cloud Scheduler job for notifications
@@ -103,16 +110,31 @@ def schedule_notifications(request):
         return (json.dumps({'error': f'Error scheduling notifications: {str(e)}'}), 500, headers)
 
 
+def get_scheduler_client():
+    """
+    Return the shared Cloud Scheduler client, creating it on first use
+    """
+    global scheduler_client
+    if scheduler_client is None:
+        from google.cloud import scheduler_v1
+        scheduler_client = scheduler_v1.CloudSchedulerClient()
+    return scheduler_client
+
+
 def create_scheduler_job(patient_id, frequency, time, days):
     """
     Create a Cloud Scheduler job to trigger notifications
     """
-    # Delete any existing jobs for this patient
+    from google.cloud import scheduler_v1
+    client = get_scheduler_client()
+    
+    job_name = f"{parent}/jobs/patient-{patient_id}-notifications"
+    
+    # Delete the existing job for this patient, if any
     try:
-        existing_jobs = scheduler_client.list_jobs(request={"parent": parent})
-        for job in existing_jobs:
-            if f"patient-{patient_id}" in job.name:
-                scheduler_client.delete_job(request={"name": job.name})
+        client.delete_job(request={"name": job_name})
+    except NotFound:
+        pass
     except Exception as e:
         print(f"Error cleaning up existing jobs: {str(e)}")
     
@@ -126,12 +148,8 @@ def create_scheduler_job(patient_id, frequency, time, days):
         if not days or len(days) == 0:
             days = ['monday']  # Default to Monday
         
-        # Convert days to cron format (0=Sunday, 1=Monday, etc.)
-        day_map = {
-            'sunday': 0, 'monday': 1, 'tuesday': 2, 'wednesday': 3,
-            'thursday': 4, 'friday': 5, 'saturday': 6
-        }
-        day_numbers = [str(day_map.get(day.lower(), 1)) for day in days]
+        # Convert days to cron format
+        day_numbers = [str(DAY_MAP.get(day.lower(), 1)) for day in days]
         day_spec = ','.join(day_numbers)
         
         schedule = f"{minute} {hour} * * {day_spec}"  # Weekly on specified days
@@ -142,8 +160,6 @@ def create_scheduler_job(patient_id, frequency, time, days):
     # Create HTTP target for the Cloud Function that sends notifications
     target_function_url = f"https://{location_id}-{project_id}.cloudfunctions.net/send_notification"
     
-    job_name = f"{parent}/jobs/patient-{patient_id}-notifications"
-    
     job = {
         "name": job_name,
         "description": f"Exercise notification schedule for patient {patient_id}",
@@ -152,40 +168,35 @@ def create_scheduler_job(patient_id, frequency, time, days):
         "http_target": {
             "uri": target_function_url,
             "http_method": scheduler_v1.HttpMethod.POST,
-            "body": json.dumps({
-                "patient_id": patient_id
-            }).encode(),
+            "body": json.dumps({'patient_id': patient_id}).encode(),
             "headers": {
                 "Content-Type": "application/json"
             }
         }
     }
     
-    # Create or update the job
+    # Create the job; the old one was deleted above, so only fall back to an
+    # update if the delete did not go through
     try:
-        response = scheduler_client.create_job(
+        response = client.create_job(
             request={"parent": parent, "job": job}
         )
-        return {
-            "name": response.name,
-            "schedule": response.schedule,
-            "time_zone": response.time_zone,
-            "state": str(response.state)
-        }
-    except Exception as e:
-        # If job already exists, update it
+    except AlreadyExists:
         try:
-            response = scheduler_client.update_job(
+            response = client.update_job(
                 request={"job": job}
             )
-            return {
-                "name": response.name,
-                "schedule": response.schedule,
-                "time_zone": response.time_zone,
-                "state": str(response.state)
-            }
         except Exception as update_error:
             raise Exception(f"Failed to create or update scheduler job: {str(update_error)}")
+    except Exception as e:
+        raise Exception(f"Failed to create or update scheduler job: {str(e)}")
+    
+    return {
+        "name": response.name,
+        "schedule": response.schedule,
+        "time_zone": response.time_zone,
+        "state": str(response.state)
+    }
 
 
 @functions_framework.http
@@ -220,7 +231,7 @@ def send_notification(request):
             return (json.dumps({'error': 'Patient has no FCM token'}), 400)
         
         # Send the notification
-        result = send_exercise_notification(patient_id, fcm_token)
+        result = send_exercise_notification(patient_id, fcm_token, patient_data)
         
         # Return success response
         return (json.dumps({
@@ -233,24 +244,30 @@ def send_notification(request):
         return (json.dumps({'error': f'Error sending notification: {str(e)}'}), 500)
 
 
-def send_exercise_notification(patient_id, fcm_token):
+def send_exercise_notification(patient_id, fcm_token, patient_data=None):
     """
-    Send an exercise reminder notification to a patient's device via FCM
+    Send an exercise reminder notification to a patient's device via FCM.
+    Pass patient_data if the caller has already loaded the patient document.
     """
     # Get patient details
-    patient_doc = db.collection('patients').document(patient_id).get()
-    patient_data = patient_doc.to_dict()
+    if patient_data is None:
+        patient_doc = db.collection('patients').document(patient_id).get()
+        patient_data = patient_doc.to_dict()
     patient_name = patient_data.get('name', 'Patient')
     
-    # Get patient exercises
-    patient_exercises = db.collection('patient_exercises').where('patient_id', '==', patient_id).get()
+    # Get patient exercise IDs, streaming only the field that is used
+    patient_exercises = db.collection('patient_exercises').where('patient_id', '==', patient_id).select(['exercise_id']).stream()
     exercise_ids = [doc.to_dict().get('exercise_id') for doc in patient_exercises]
     
-    # Get exercise details
+    # Get exercise details in a single batched read
+    exercise_refs = [db.collection('exercises').document(ex_id) for ex_id in exercise_ids if ex_id]
+    exercise_docs = {doc.id: doc for doc in db.get_all(exercise_refs)} if exercise_refs else {}
+    
+    # get_all does not preserve order, so walk the assignments to keep it stable
     exercise_names = []
     for ex_id in exercise_ids:
-        ex_doc = db.collection('exercises').document(ex_id).get()
-        if ex_doc.exists:
+        ex_doc = exercise_docs.get(ex_id)
+        if ex_doc is not None and ex_doc.exists:
             ex_data = ex_doc.to_dict()
             exercise_names.append(ex_data.get('name'))
     
@@ -264,8 +281,9 @@ def send_exercise_notification(patient_id, fcm_token):
     else:
         body = f"Hi {patient_name}! Don't forget to complete your exercises today."
     
-    # Save notification to database
+    # Build the notification record
     notification_id = str(uuid.uuid4())
+    notification_ref = db.collection('notifications').document(notification_id)
     notification = {
         'id': notification_id,
         'patient_id': patient_id,
@@ -274,11 +292,9 @@ def send_exercise_notification(patient_id, fcm_token):
         'scheduled_for': datetime.now(),
         'exercise_ids': exercise_ids,
         'status': 'sending',
-        'created_at': datetime.now()
+        'created_at': firestore.SERVER_TIMESTAMP
     }
     
-    db.collection('notifications').document(notification_id).set(notification)
-    
     # Create message
     message = messaging.Message(
         notification=messaging.Notification(
@@ -314,28 +330,44 @@ def send_exercise_notification(patient_id, fcm_token):
         ),
     )
     
-    # Send message
+    # Save the notification and send the message concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        save_future = executor.submit(notification_ref.set, notification)
+        send_future = executor.submit(messaging.send, message)
+    
+    # The record must exist before its status can be updated
+    saved = save_future.exception() is None
+    if not saved:
+        print(f"Error saving notification {notification_id}: {str(save_future.exception())}")
+    
     try:
-        response = messaging.send(message)
-        
-        # Update notification status
-        db.collection('notifications').document(notification_id).update({
-            'status': 'sent',
-            'fcm_response': response,
-            'updated_at': datetime.now()
-        })
-        
-        return {
-            'success': True,
-            'message_id': response,
-            'notification_id': notification_id
-        }
+        response = send_future.result()
     except Exception as e:
         # Update notification status
-        db.collection('notifications').document(notification_id).update({
-            'status': 'failed',
-            'error': str(e),
-            'updated_at': datetime.now()
-        })
+        if saved:
+            notification_ref.update({
+                'status': 'failed',
+                'error': str(e),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            })
         
-        raise Exception(f"Failed to send notification: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Failed to send notification: {str(e)}")
+    
+    # The message has been delivered, so failing to record it must not fail the
+    # request; the scheduler would retry and send the reminder twice
+    try:
+        if saved:
+            # Update notification status
+            notification_ref.update({
+                'status': 'sent',
+                'fcm_response': response,
+                'updated_at': firestore.SERVER_TIMESTAMP
+            })
+    except Exception as e:
+        print(f"Error updating notification {notification_id}: {str(e)}")
+    
+    return {
+        'success': True,
+        'message_id': response,
+        'notification_id': notification_id
+    }
\ No newline at end of file